@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Shigeru Kitazaki
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Benchmark each stage of "boilerplate.py" on a synthetic corpus.
+Results are written as JSON to compare runs.
+"""
+
+import argparse
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import boilerplate
+from boilerplate import (App, MONITOR_DUMP_FIELDS, ProgressMonitor, Tabular,
+                         TabularReader, collect_files, md5sum, open_input,
+                         process_path)
+
+__version__ = boilerplate.__version__
+__author__ = boilerplate.__author__
+
+DEFAULT_SEED = 20150101
+DEFAULT_REPEAT = 3
+DEFAULT_SMALL_FILES = 1000
+DEFAULT_HUGE_FILES = 2
+DEFAULT_HUGE_SIZE = 64  # MB
+DEFAULT_DEPTH = 8
+DEFAULT_GZIP_RATIO = 0.25
+DEFAULT_RECORDS = 100000
+
+# Fields of synthetic CSV records, and to encode by `Tabular`, and to decode
+# by `TabularReader`.
+RECORD_FIELDS = (
+    {'name': 'id', 'type': 'string'},
+    {'name': 'updated', 'type': 'datetime', 'format': '%Y-%m-%dT%H:%M:%SZ'},
+    {'name': 'name', 'type': 'string'},
+    {'name': 'latitude', 'type': 'float'},
+    {'name': 'longitude', 'type': 'float'},
+    {'name': 'zipcode', 'type': 'string'},
+    {'name': 'kind', 'type': 'string', 'default': 'UNKNOWN'},
+    {'name': 'update_type', 'type': 'integer'}
+)
+
+
+def parse_arguments():
+    """Parse arguments.
+
+    :rtype: parsed arguments as Namespace object.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('-V', '--version', action='version',
+                        version='%(prog)s ' + __version__)
+
+    parser.add_argument('-d', '--corpus', dest='corpus', required=False,
+                        help='corpus directory, generated if not exists '
+                             '(default: temporary directory)', metavar='DIR')
+    parser.add_argument('-o', '--output', dest='output', required=False,
+                        help='output JSON file (default: stdout)',
+                        metavar='FILE')
+    parser.add_argument('-n', '--repeat', dest='repeat', type=int,
+                        default=DEFAULT_REPEAT,
+                        help='times to repeat each stage '
+                             '(default: {})'.format(DEFAULT_REPEAT))
+    parser.add_argument('--seed', dest='seed', type=int,
+                        default=DEFAULT_SEED,
+                        help='random seed of the corpus '
+                             '(default: {})'.format(DEFAULT_SEED))
+    parser.add_argument('--small-files', dest='small_files', type=int,
+                        default=DEFAULT_SMALL_FILES, metavar='N',
+                        help='number of small files '
+                             '(default: {})'.format(DEFAULT_SMALL_FILES))
+    parser.add_argument('--huge-files', dest='huge_files', type=int,
+                        default=DEFAULT_HUGE_FILES, metavar='N',
+                        help='number of huge files '
+                             '(default: {})'.format(DEFAULT_HUGE_FILES))
+    parser.add_argument('--huge-size', dest='huge_size', type=int,
+                        default=DEFAULT_HUGE_SIZE, metavar='MB',
+                        help='size of a huge file '
+                             '(default: {})'.format(DEFAULT_HUGE_SIZE))
+    parser.add_argument('--depth', dest='depth', type=int,
+                        default=DEFAULT_DEPTH,
+                        help='depth of directory tree '
+                             '(default: {})'.format(DEFAULT_DEPTH))
+    parser.add_argument('--gzip-ratio', dest='gzip_ratio', type=float,
+                        default=DEFAULT_GZIP_RATIO, metavar='RATIO',
+                        help='ratio of gzip files '
+                             '(default: {})'.format(DEFAULT_GZIP_RATIO))
+    parser.add_argument('--records', dest='records', type=int,
+                        default=DEFAULT_RECORDS, metavar='N',
+                        help='number of records to encode by Tabular '
+                             '(default: {})'.format(DEFAULT_RECORDS))
+
+    return parser.parse_args()
+
+
+def make_record(rnd, i):
+    # Synthetic record of `RECORD_FIELDS`.
+    return {
+        'id': '{:08d}'.format(i),
+        'updated': datetime.datetime(2015, 1, 1) +
+        datetime.timedelta(seconds=rnd.randrange(86400 * 365)),
+        'name': ''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz')
+                        for _ in range(rnd.randrange(4, 16))),
+        'latitude': rnd.uniform(-90, 90),
+        'longitude': rnd.uniform(-180, 180),
+        'zipcode': '{:07d}'.format(rnd.randrange(10 ** 7)),
+        'kind': rnd.choice(('A', 'B', 'C', None)),
+        'update_type': rnd.randrange(4),
+    }
+
+
+def make_lines(rnd, size):
+    # CSV lines of about `size` bytes with header.
+    header = ','.join(f['name'] for f in RECORD_FIELDS) + '\n'
+    lines = [header]
+    written = len(header)
+    i = 0
+    while written < size:
+        r = make_record(rnd, i)
+        line = '{},{:%Y-%m-%dT%H:%M:%SZ},{},{:.6f},{:.6f},{},{},{}\n'.format(
+            r['id'], r['updated'], r['name'], r['latitude'], r['longitude'],
+            r['zipcode'], r['kind'] or '', r['update_type'])
+        lines.append(line)
+        written += len(line)
+        i += 1
+    return ''.join(lines).encode('utf8')
+
+
+def generate_corpus(basedir, seed=DEFAULT_SEED,
+                    small_files=DEFAULT_SMALL_FILES,
+                    huge_files=DEFAULT_HUGE_FILES,
+                    huge_size=DEFAULT_HUGE_SIZE * 1024 * 1024,
+                    depth=DEFAULT_DEPTH, gzip_ratio=DEFAULT_GZIP_RATIO):
+    '''Generate CSV files in `basedir` as the same contents for `seed`.
+    Small files are spread over a directory tree of `depth`, and huge files
+    are put on the top. Gzip file is mixed in both at `gzip_ratio`.
+    Return the list of generated paths.
+    '''
+    rnd = random.Random(seed)
+    paths = []
+
+    def write(path, data):
+        if rnd.random() < gzip_ratio:
+            path += '.gz'
+            # Fixed mtime to get the same bytes every time.
+            with open(path, 'wb') as fp:
+                with gzip.GzipFile(fileobj=fp, mode='wb', mtime=0) as gz:
+                    gz.write(data)
+        else:
+            with open(path, 'wb') as fp:
+                fp.write(data)
+        paths.append(path)
+
+    for i in range(small_files):
+        # Directory of random depth, whose parents are shared by the others.
+        parts = ['d{}'.format(rnd.randrange(4))
+                 for _ in range(rnd.randrange(depth + 1))]
+        d = os.path.join(basedir, *parts)
+        os.makedirs(d, exist_ok=True)
+        write(os.path.join(d, 'small{:06d}.csv'.format(i)),
+              make_lines(rnd, rnd.randrange(64, 64 * 1024)))
+    # A huge file repeats a block not to take long time to generate.
+    block = make_lines(rnd, 1024 * 1024).split(b'\n', 1)[1]
+    for i in range(huge_files):
+        header = ','.join(f['name'] for f in RECORD_FIELDS) + '\n'
+        data = header.encode('utf8') + block * max(huge_size // len(block), 1)
+        write(os.path.join(basedir, 'huge{:03d}.csv'.format(i)), data)
+    return sorted(paths)
+
+
+def measure(func, repeat):
+    '''Call `func` `repeat` times, and return the statistics of elapsed
+    seconds with the value returned by the last call.
+    '''
+    elapsed = []
+    r = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        r = func()
+        elapsed.append(time.perf_counter() - t)
+    return {
+        'repeat': repeat,
+        'min': min(elapsed),
+        'median': statistics.median(elapsed),
+        'max': max(elapsed),
+    }, r
+
+
+class Benchmark(object):
+
+    """Stages to measure on the corpus.
+    Each stage returns a dict of the number of items and bytes it handles.
+    """
+
+    STAGES = ('startup', 'collect_files', 'md5sum', 'app_process',
+              'app_scan', 'monitor_cycle', 'monitor_dump', 'tabular_encode',
+              'tabular_decode')
+
+    def __init__(self, corpus, workdir, records=DEFAULT_RECORDS, seed=0):
+        self.corpus = corpus
+        self.workdir = workdir
+        self.records = records
+        self.seed = seed
+        self.files = collect_files([corpus], True)
+        self.digests = {}
+        self.db = None
+
+    def run(self, repeat, stages=STAGES):
+        results = {}
+        for name in stages:
+            stats, r = measure(getattr(self, name), repeat)
+            stats.update(r)
+            if r.get('bytes'):
+                stats['throughput'] = r['bytes'] / stats['min']
+            results[name] = stats
+        return results
+
+    def startup(self):
+        # Run the script as a module to use the cached bytecode.
+        subprocess.run([sys.executable, '-m', boilerplate.APPNAME,
+                        '--version'], cwd=boilerplate.BASEDIR, check=True,
+                       stdout=subprocess.DEVNULL)
+        return {'items': 1}
+
+    def collect_files(self):
+        files = collect_files([self.corpus], True)
+        return {'items': len(files)}
+
+    def md5sum(self):
+        nbytes = 0
+        for path in self.files:
+            self.digests[path] = md5sum(path)
+            nbytes += os.path.getsize(path)
+        return {'items': len(self.files), 'bytes': nbytes}
+
+    def app_process(self):
+        app = App(None)
+        lines = 0
+        for path in self.files:
+            with open_input(path, 'utf8') as fp:
+                lines += app.process(fp, True)['lines']
+        return {'items': len(self.files), 'lines': lines}
+
+    def app_scan(self):
+        # Binary fast path of `App.scan()` as `process_path()` runs it.
+        app = App(None)
+        app.needs_text = False
+        lines = nbytes = 0
+        for path in self.files:
+            r, _, stats = process_path(app, path, 'utf8', True)
+            lines += r['lines']
+            nbytes += stats['bytes_read']
+        return {'items': len(self.files), 'lines': lines, 'bytes': nbytes}
+
+    def monitor_cycle(self):
+        # Digest is given not to measure hashing again.
+        if not self.digests:
+            self.md5sum()
+        if self.db:
+            self.db.close()
+        self.db = sqlite3.connect(os.path.join(self.workdir, 'monitor.db'))
+        cur = self.db.cursor()
+        cur.execute('DROP TABLE IF EXISTS {}'.format(
+            ProgressMonitor.TABLE_NAME))
+        cur.close()
+        monitor = ProgressMonitor(self.db)
+        for path in self.files:
+            # Huge files of the same contents are skipped.
+            if monitor.start(path, self.digests[path]) is None:
+                monitor.finish({'lines': 0})
+        monitor.commit()
+        return {'items': len(self.files)}
+
+    def monitor_dump(self):
+        if self.db is None:
+            self.monitor_cycle()
+        dump = os.path.join(self.workdir, 'dump.tsv')
+        if os.path.exists(dump):
+            os.remove(dump)
+        monitor = ProgressMonitor(self.db, dump)
+        n = monitor.terminate(MONITOR_DUMP_FIELDS)
+        return {'items': n, 'bytes': os.path.getsize(dump)}
+
+    def tabular_encode(self):
+        rnd = random.Random(self.seed)
+        records = [make_record(rnd, i) for i in range(self.records)]
+        encoder = Tabular(RECORD_FIELDS)
+        n = sum(1 for _ in encoder.encode_many(records))
+        return {'items': n}
+
+    def tabular_decode(self):
+        rnd = random.Random(self.seed)
+        records = [make_record(rnd, i) for i in range(self.records)]
+        encoder = Tabular(RECORD_FIELDS)
+        fp = io.StringIO()
+        writer = csv.writer(fp)
+        writer.writerow(encoder.header())
+        writer.writerows(encoder.encode_many(records))
+        text = fp.getvalue()
+        reader = TabularReader(RECORD_FIELDS)
+        n = sum(len(batch['id'])
+                for batch in reader.read(io.StringIO(text)))
+        return {'items': n, 'bytes': len(text.encode('utf8'))}
+
+    def close(self):
+        if self.db:
+            self.db.close()
+
+
+def environment():
+    return {
+        'version': __version__,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'started_at': datetime.datetime.now().isoformat(),
+    }
+
+
+def main():
+    args = parse_arguments()
+    params = {
+        'seed': args.seed,
+        'small_files': args.small_files,
+        'huge_files': args.huge_files,
+        'huge_size': args.huge_size * 1024 * 1024,
+        'depth': args.depth,
+        'gzip_ratio': args.gzip_ratio,
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        corpus = args.corpus or os.path.join(workdir, 'corpus')
+        if not os.path.isdir(corpus):
+            os.makedirs(corpus)
+            t = time.perf_counter()
+            files = generate_corpus(corpus, **params)
+            print('Generated {:,} files in {:.3f}sec: {}'.format(
+                len(files), time.perf_counter() - t, corpus), file=sys.stderr)
+        bench = Benchmark(corpus, workdir, args.records, args.seed)
+        try:
+            results = bench.run(args.repeat)
+        finally:
+            bench.close()
+        nbytes = sum(os.path.getsize(p) for p in bench.files)
+    report = {
+        'environment': environment(),
+        'corpus': dict(params, path=os.path.abspath(corpus),
+                       files=len(bench.files), bytes=nbytes),
+        'stages': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
+
+
+# Test suites to bundle as one file script.
+# To run the tests, invoke this script using "-m unittest" option.
+# i.e. `python3 -m unittest -v bench_boilerplate.py`
+import unittest
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _generate(self, name, seed):
+        d = os.path.join(self.tmpdir.name, name)
+        os.makedirs(d)
+        files = generate_corpus(d, seed, small_files=20, huge_files=1,
+                                huge_size=2 * 1024 * 1024, depth=3,
+                                gzip_ratio=0.5)
+        contents = {}
+        for path in files:
+            with open(path, 'rb') as fp:
+                contents[os.path.relpath(path, d)] = fp.read()
+        return contents
+
+    def test_generate_corpus(self):
+        a = self._generate('a', 1)
+        self.assertEqual(21, len(a))
+        self.assertTrue(any(p.endswith('.gz') for p in a))
+        self.assertTrue(any(os.sep in p for p in a))
+        self.assertEqual(a, self._generate('b', 1))
+        self.assertNotEqual(a, self._generate('c', 2))
+
+    def test_run(self):
+        corpus = os.path.join(self.tmpdir.name, 'corpus')
+        os.makedirs(corpus)
+        generate_corpus(corpus, small_files=10, huge_files=1,
+                        huge_size=1024 * 1024, depth=2)
+        bench = Benchmark(corpus, self.tmpdir.name, records=100)
+        try:
+            results = bench.run(1)
+        finally:
+            bench.close()
+        self.assertEqual(set(Benchmark.STAGES), set(results))
+        self.assertEqual(1, results['startup']['items'])
+        for name in ('collect_files', 'md5sum', 'app_process', 'app_scan',
+                     'monitor_cycle', 'monitor_dump'):
+            self.assertEqual(11, results[name]['items'], name)
+        self.assertGreater(results['app_process']['lines'], 11)
+        self.assertEqual(results['app_process']['lines'],
+                         results['app_scan']['lines'])
+        self.assertGreater(results['app_scan']['throughput'], 0)
+        self.assertEqual(100, results['tabular_encode']['items'])
+        self.assertEqual(100, results['tabular_decode']['items'])
+        self.assertGreater(results['md5sum']['throughput'], 0)
+        json.dumps(results)
@@ -28,81 +28,160 @@ TODO: Write description on your own.
 """
 
 import argparse
-import configparser
-import csv
-import datetime
-import gzip
-import hashlib
-import json
+import io
 import logging
-import logging.config
 import os
-import sqlite3
+import queue
 import sys
+import threading
 import time
 import traceback
-from collections import Counter
+import zlib
+from collections import Counter, deque
 from functools import partial
-from pathlib import Path
+from itertools import chain, islice
+
+# Modules used only on some code paths, such as "sqlite3", "gzip" or "json",
+# are imported in the functions to start up fast, see `ImportTimeTest`.
 
 __version__ = '0.1.0'
 __author__ = 'Shigeru Kitazaki'
 
-APPNAME = Path(__file__).stem
-BASEDIR = Path(__file__).parent.resolve()
+APPNAME = os.path.splitext(os.path.basename(__file__))[0]
+BASEDIR = os.path.dirname(os.path.realpath(__file__))
 
 DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 CONFIG_FILE_ENCODING = 'utf8'
 DEFAULT_SQLITE_FILE = ':memory:'
 DEFAULT_INPUT_FILE_ENCODING = 'utf8'
 DEFAULT_OUTPUT_FILE_ENCODING = 'utf8'
-DEFAULT_LOG_DIRECTORY = Path.cwd()
-
-logging.config.dictConfig({
-    'version': 1,
-    'disable_existing_loggers': False,
-    'formatters': {
-        'standard': {
-            'datefmt': '%Y-%m-%d %H:%M:%S',
-            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
-        },
-        'detailed': {
-            'datefmt': '%Y-%m-%d %H:%M:%S',
-            'format': '%(asctime)s [%(levelname)s] %(name)s '
-                      '%(filename)s:L%(lineno)-4d: %(message)s'
-        }
-    },
-    'handlers': {
-        'console': {
-            'class': 'logging.StreamHandler',
-            'level': 'INFO',
-            'stream': 'ext://sys.stderr',
-            'formatter': 'standard'
+DEFAULT_LOG_DIRECTORY = os.getcwd()
+DEFAULT_HASH_ALGORITHM = 'md5'
+# `hashlib.algorithms_guaranteed` except SHAKE of variable length, listed
+# not to import `hashlib` on parsing arguments.
+HASH_ALGORITHMS = ('blake2b', 'blake2s', 'md5', 'sha1', 'sha224', 'sha256',
+                   'sha384', 'sha3_224', 'sha3_256', 'sha3_384', 'sha3_512',
+                   'sha512')
+DEFAULT_HASH_BUFFER_SIZE = 1024 * 1024
+FINGERPRINT_SAMPLE_SIZE = 1024 * 1024
+DEFAULT_COMMIT_EVERY = 1000
+DEFAULT_COMMIT_INTERVAL = 10.0
+DEFAULT_JOURNAL_MODE = 'WAL'
+DUMP_BATCH_SIZE = 10000
+SCAN_BLOCK_SIZE = 1024 * 1024
+GZIP_BLOCK_SIZE = 1024 * 1024
+GZIP_QUEUE_DEPTH = 8
+GZIP_INDEX_SPAN = 16 * 1024 * 1024
+DUMP_BUFFER_SIZE = 1024 * 1024
+DEFAULT_WATCH_INTERVAL = 5.0
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+OUTPUT_QUEUE_DEPTH = 8
+DEFAULT_METRICS_INTERVAL = 10.0
+TABULAR_BATCH_SIZE = 65536
+INGEST_BATCH_SIZE = 10000
+INGEST_CACHE_SIZE = 256 * 1024  # KiB
+
+
+# (logger, `QueueListener`) pairs of `setup_logging()`.
+_log_listeners = []
+
+
+def setup_logging():
+    '''Configure logging, which is deferred until the arguments are parsed
+    not to open the log file on importing this module or showing help.
+    Records are passed through queues to the handlers on background threads,
+    so that writing the log file does not block the processing.
+    '''
+    import atexit
+    import logging.config
+    import logging.handlers
+    logging.config.dictConfig({
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {
+            'standard': {
+                'datefmt': '%Y-%m-%d %H:%M:%S',
+                'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+            },
+            'detailed': {
+                'datefmt': '%Y-%m-%d %H:%M:%S',
+                'format': '%(asctime)s [%(levelname)s] %(name)s '
+                          '%(filename)s:L%(lineno)-4d: %(message)s'
+            }
         },
-        'file': {
-            'class': 'logging.handlers.RotatingFileHandler',
-            'level': 'DEBUG',
-            'formatter': 'detailed',
-            'filename': DEFAULT_LOG_DIRECTORY / (APPNAME + '.log'),
-            'mode': 'a',
-            'maxBytes': 10485760,
-            'backupCount': 5,
-            'encoding': 'utf8'
-        }
-    },
-    'loggers': {
-        '': {
-            'handlers': ['console'],
-            'level': 'INFO',
-            'propagate': True
+        'handlers': {
+            'console': {
+                'class': 'logging.StreamHandler',
+                'level': 'INFO',
+                'stream': 'ext://sys.stderr',
+                'formatter': 'standard'
+            },
+            'file': {
+                'class': 'logging.handlers.RotatingFileHandler',
+                'level': 'DEBUG',
+                'formatter': 'detailed',
+                'filename': os.path.join(DEFAULT_LOG_DIRECTORY,
+                                         APPNAME + '.log'),
+                'mode': 'a',
+                'maxBytes': 10485760,
+                'backupCount': 5,
+                'encoding': 'utf8'
+            }
         },
-        APPNAME: {
-            'handlers': ['console', 'file'],
-            'level': 'WARN',
-            'propagate': False
+        'loggers': {
+            '': {
+                'handlers': ['console'],
+                'level': 'INFO',
+                'propagate': True
+            },
+            APPNAME: {
+                'handlers': ['console', 'file'],
+                'level': 'WARN',
+                'propagate': False
+            }
         }
-    }
-})
+    })
+    for name in ('', APPNAME):
+        logger = logging.getLogger(name)
+        q = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(
+            q, *logger.handlers, respect_handler_level=True)
+        logger.handlers = [_LocalQueueHandler(q)]
+        listener.start()
+        _log_listeners.append((logger, listener))
+    atexit.register(stop_logging)
+
+
+class _LocalQueueHandler(logging.Handler):
+
+    '''Put records into the queue of `QueueListener` in this process.
+    Only the message is merged with its arguments here, which may be
+    changed later, and the rest is formatted on the listener thread.
+    '''
+
+    def __init__(self, queue):
+        super().__init__()
+        self.queue = queue
+
+    def emit(self, record):
+        # Called only for the records of enabled levels.
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            self.queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+def stop_logging(wait=True):
+    '''Handle queued records if `wait`, and let the handlers work directly
+    again.
+    '''
+    while _log_listeners:
+        logger, listener = _log_listeners.pop()
+        if wait:
+            listener.stop()
+        logger.handlers = list(listener.handlers)
 
 
 def parse_arguments():
@@ -121,8 +200,19 @@ def parse_arguments():
                         help='local SQLite3 file', metavar='FILE')
     parser.add_argument('-M', '--monitor-output', dest='monitor_out',
                         help='progress monitor dump file', metavar='FILE')
+    parser.add_argument('--monitor-since', dest='monitor_since', type=int,
+                        help='dump monitor records after the seq',
+                        metavar='SEQ')
     parser.add_argument('-o', '--output', dest='output',
                         help='output path', metavar='FILE')
+    parser.add_argument('--output-buffer', dest='output_buffer', type=int,
+                        default=OUTPUT_BUFFER_SIZE // 1024, metavar='KB',
+                        help='buffer KB kilo characters of output to write '
+                             'on a background thread (default: %(default)s)')
+    parser.add_argument('--output-partition', dest='output_partition',
+                        type=partition_type, metavar='input|N',
+                        help='split output into numbered files for each '
+                             'input file, or every N lines')
     parser.add_argument('-n', '--dryrun', dest='dryrun',
                         help='dry run', default=False, action='store_true')
     parser.add_argument('-e', '--encoding', dest='encoding',
@@ -133,6 +223,96 @@ def parse_arguments():
                         default=DEFAULT_OUTPUT_FILE_ENCODING)
     parser.add_argument('-r', '--recursive', dest='recursive', default=False,
                         help='search recursive', action='store_true')
+    parser.add_argument('--single-pass', dest='single_pass', default=False,
+                        help='calculate the digest while processing input '
+                             'files',
+                        action='store_true')
+    parser.add_argument('--verify-digest', dest='verify_digest',
+                        default=False, action='store_true',
+                        help='calculate the digest even if file is '
+                             'unchanged')
+    parser.add_argument('--digest-algorithm', dest='algorithm',
+                        default=DEFAULT_HASH_ALGORITHM,
+                        choices=HASH_ALGORITHMS,
+                        help='hash algorithm to detect processed files '
+                             '(default: %(default)s)')
+    parser.add_argument('--fingerprint', dest='fingerprint', type=int,
+                        default=0, metavar='MB',
+                        help='identify files larger than MB megabytes by '
+                             'the samples of head, middle and tail')
+    parser.add_argument('--upgrade-digest', dest='upgrade_digest',
+                        default=False, action='store_true',
+                        help='calculate full digest of the files identified '
+                             'by samples in the background')
+    parser.add_argument('--hash-jobs', dest='hash_jobs', type=int, default=1,
+                        help='number of threads to calculate hash values',
+                        metavar='N')
+    parser.add_argument('--stream', dest='stream', default=False,
+                        help='process files while searching directories',
+                        action='store_true')
+    parser.add_argument('--commit-every', dest='commit_every', type=int,
+                        default=DEFAULT_COMMIT_EVERY, metavar='N',
+                        help='commit monitor records every N files '
+                             '(default: %(default)s)')
+    parser.add_argument('--commit-interval', dest='commit_interval',
+                        type=float, default=DEFAULT_COMMIT_INTERVAL,
+                        metavar='SEC',
+                        help='commit monitor records every SEC seconds '
+                             '(default: %(default)s)')
+    parser.add_argument('--journal-mode', dest='journal_mode',
+                        default=DEFAULT_JOURNAL_MODE, metavar='MODE',
+                        help='journal mode of local SQLite3 file '
+                             '(default: %(default)s)')
+    parser.add_argument('--gzip-index', dest='gzip_index', default=False,
+                        help='split gzip file by access points to process '
+                             'in parallel with --chunk-size',
+                        action='store_true')
+    parser.add_argument('--gzip-pipeline', dest='pipeline', default=False,
+                        help='decompress gzip file on a background thread',
+                        action='store_true')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='number of worker processes', metavar='N')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+                        default=0, metavar='MB',
+                        help='split uncompressed file larger than MB '
+                             'megabytes to process in parallel')
+    parser.add_argument('--checkpoint', dest='checkpoint', type=int,
+                        default=0, metavar='MB',
+                        help='save progress every MB megabytes of a file to '
+                             'resume after a crash (serial run counting '
+                             'lines by App.scan() only, ignored with a '
+                             'warning otherwise)')
+    parser.add_argument('--shard', dest='shard', type=shard_type,
+                        metavar='I/N',
+                        help='process only the files of I-th shard of N '
+                             'shards assigned by the path hash, 0 <= I < N')
+    parser.add_argument('--merge', dest='merge', default=False,
+                        action='store_true',
+                        help='merge monitor records of SQLite3 files given '
+                             'as inputs, which are run by --shard, into -s '
+                             'file')
+    parser.add_argument('--ingest', dest='ingest', metavar='TABLE',
+                        help='load rows of input files into TABLE of -s '
+                             'file (serial run only)')
+    parser.add_argument('--ingest-index', dest='ingest_indexes',
+                        action='append', default=[], metavar='COL[,COL]',
+                        help='create index on the columns of --ingest table '
+                             'after loading, can be given multiple times')
+    parser.add_argument('--watch', dest='watch', type=float, metavar='SEC',
+                        help='keep running to process new files found by '
+                             'polling the inputs every SEC seconds')
+    parser.add_argument('--metrics', dest='metrics', metavar='FILE',
+                        help='write live metrics to FILE in Prometheus text '
+                             'format if it ends with ".prom", otherwise in '
+                             'JSON')
+    parser.add_argument('--metrics-interval', dest='metrics_interval',
+                        type=float, default=DEFAULT_METRICS_INTERVAL,
+                        metavar='SEC',
+                        help='write --metrics every SEC seconds '
+                             '(default: %(default)s)')
+    parser.add_argument('--profile', dest='profile', metavar='FILE',
+                        help='write cProfile stats of the main process to '
+                             'read by `pstats`')
     parser.add_argument('files', nargs='*',
                         help='input files', metavar='FILE')
 
@@ -163,8 +343,16 @@ def parse_arguments():
     except IOError:
         e = sys.exc_info()[1]
         parser.error('File not found: %s' % (e, ))
+    if args.watch and not args.files:
+        parser.error('--watch needs input files or directories')
+    if args.merge and not args.files:
+        parser.error('--merge needs SQLite3 files to merge')
+    if args.ingest and args.single_pass:
+        # Rows would be loaded before knowing the file is a duplicate.
+        parser.error('--ingest cannot run with --single-pass')
 
     # Set up logging verbosity level.
+    setup_logging()
     logger = logging.getLogger(APPNAME)
     if args.quiet:
         logger.setLevel(logging.CRITICAL)
@@ -204,18 +392,936 @@ def collect_files(inputs, recursive=False):
         else:
             logger.fatal('File not found: %s', path)
             sys.exit(1)
-    logger.debug('Collect {:,} files.'.format(len(files)))
+    logger.debug('Collect %d files.', len(files))
     return files
 
 
+def iter_files(inputs, recursive=False):
+    '''Generator version of `collect_files()` to start processing while
+    walking directories in the same order.
+    Yield `os.DirEntry` which caches its stat result for the file found in
+    directories, and the path string for the file given.
+    '''
+    if inputs is None or len(inputs) == 0:
+        return []
+    # Check all inputs before walking, as `collect_files()` does.
+    check_inputs(inputs, recursive)
+    return _iter_inputs(inputs)
+
+
+def check_inputs(inputs, recursive=False):
+    # Exit if any input is not found, as `collect_files()` does.
+    logger = logging.getLogger(APPNAME + '.setup')
+    for path in inputs:
+        if not (os.path.isfile(path) or (os.path.isdir(path) and recursive)):
+            logger.fatal('File not found: %s', path)
+            sys.exit(1)
+
+
+def _iter_inputs(inputs):
+    logger = logging.getLogger(APPNAME + '.setup')
+    for path in inputs:
+        if os.path.isfile(path):
+            logger.debug('Target file exists: %s', path)
+            yield path
+            continue
+        logger.debug('Target directory exists: %s', path)
+        stack = [path]
+        while stack:
+            ds, fs = [], []
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        if not entry.is_dir():
+                            if not entry.name.endswith('~'):
+                                fs.append(entry)
+                        # Prune hidden and symbolic linked directory.
+                        elif not (entry.name.startswith('.') or
+                                  entry.is_symlink()):
+                            ds.append(entry.path)
+            except OSError as e:
+                logger.warning('Cannot scan directory: %s', e)
+                continue
+            # Files first, then sub directories as `os.walk()` does.
+            fs.sort(key=lambda entry: entry.name)
+            yield from fs
+            stack.extend(sorted(ds, reverse=True))
+
+
+class DirectoryWatcher(object):
+
+    '''Poll input files and directories for new files, in the same order as
+    `collect_files()`.
+    A directory is listed again only when its mtime is changed, so polling
+    unchanged trees costs a `stat` per directory. A new file is reported
+    when its stat result is the same as the previous poll, or it is older
+    than `settle` seconds, not to process the file being written.
+    Files rewritten in place are not detected, since the directory mtime
+    is not changed, but files renamed or copied into are.
+    '''
+
+    def __init__(self, inputs, recursive=False,
+                 settle=DEFAULT_WATCH_INTERVAL):
+        self.logger = logging.getLogger(APPNAME + '.watch')
+        self.inputs = inputs
+        self.recursive = recursive
+        self.settle = settle
+        self.polls = 0
+        # Directory path -> (mtime_ns, {name: stat key}, sub directories)
+        # of the files reported.
+        self.dirs = {}
+        # Directory path -> {name: (stat key, poll number)} of the files to
+        # settle. Files given by the arguments are in "" directory.
+        self.pending = {}
+        self.given = {}
+
+    @staticmethod
+    def key(st):
+        return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def poll(self):
+        '''Return the list of file paths settled since the last poll.'''
+        self.polls += 1
+        found = []
+        for path in self.inputs:
+            if os.path.isdir(path):
+                self._walk(path, found)
+                continue
+            try:
+                if self.given.get(path) == self.key(os.stat(path)):
+                    continue
+            except OSError:
+                continue
+            k = self._settle(path, path, self.pending.setdefault('', {}),
+                             found)
+            if k:
+                self.given[path] = k
+        if found:
+            self.logger.info('Found %d new files.', len(found))
+        return found
+
+    def _walk(self, top, found):
+        stack = [top]
+        while stack:
+            d = stack.pop()
+            try:
+                mtime = os.stat(d).st_mtime_ns
+            except OSError as e:
+                self.logger.warning('Cannot scan directory: %s', e)
+                self._forget(d)
+                continue
+            cached = self.dirs.get(d)
+            if cached is None or cached[0] != mtime:
+                cached = self._scan(d, mtime, cached)
+            pending = self.pending.get(d)
+            if pending:
+                for name in sorted(pending):
+                    k = self._settle(os.path.join(d, name), name, pending,
+                                     found)
+                    if k:
+                        cached[1][name] = k
+            stack.extend(sorted(cached[2], reverse=True))
+
+    def _scan(self, d, mtime, cached):
+        # List the directory, and wait for new or replaced files to settle.
+        self.logger.debug('Scan directory: %s', d)
+        old = cached[1] if cached else {}
+        oldpending = self.pending.get(d, {})
+        reported, pending, subdirs = {}, {}, []
+        try:
+            with os.scandir(d) as it:
+                for entry in it:
+                    if not entry.is_dir():
+                        if entry.name.endswith('~'):
+                            continue
+                        k = self.key(entry.stat())
+                        if old.get(entry.name) == k:
+                            reported[entry.name] = k
+                        else:
+                            pending[entry.name] = oldpending.get(
+                                entry.name, (k, self.polls))
+                    # Prune hidden and symbolic linked directory.
+                    elif (self.recursive and not entry.name.startswith('.')
+                          and not entry.is_symlink()):
+                        subdirs.append(entry.path)
+        except OSError as e:
+            self.logger.warning('Cannot scan directory: %s', e)
+        for path in set(cached[2] if cached else []) - set(subdirs):
+            self._forget(path)
+        self.dirs[d] = cached = (mtime, reported, subdirs)
+        self.pending[d] = pending
+        return cached
+
+    def _forget(self, d):
+        # Forget the directory removed, and its descendants.
+        prefix = os.path.join(d, '')
+        for path in [p for p in self.dirs if p == d or p.startswith(prefix)]:
+            self.dirs.pop(path, None)
+            self.pending.pop(path, None)
+
+    def _settle(self, path, name, pending, found):
+        '''Report the file and return its stat key if it is settled,
+        otherwise keep it pending by the `name`.
+        '''
+        try:
+            st = os.stat(path)
+        except OSError:
+            pending.pop(name, None)
+            return None
+        k = self.key(st)
+        last, polls = pending.get(name, (None, self.polls))
+        if (k == last and polls < self.polls) or \
+                time.time() - st.st_mtime >= self.settle:
+            pending.pop(name, None)
+            found.append(path)
+            return k
+        pending[name] = (k, self.polls)
+        return None
+
+
+def shard_type(value):
+    '''Parse "I/N" of `--shard` into (I, N) tuple where 0 <= I < N.'''
+    try:
+        i, n = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid shard: ' + value)
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError('shard out of range: ' + value)
+    return i, n
+
+
+def in_shard(path, shard):
+    # Assign the path to a shard by its hash, the same on any host. CRC32 of
+    # similar paths modulo a power of two clusters, so use MD5 instead.
+    import hashlib
+    i, n = shard
+    h = hashlib.md5(path.replace('\\', '/').encode('utf8')).digest()
+    return int.from_bytes(h[:8], 'big') % n == i
+
+
+def walk_key(path):
+    '''Sort key of the path in the order `collect_files()` walks, where
+    files come before sub directories.
+    '''
+    parts = path.replace('\\', '/').split('/')
+    return [(1, p) for p in parts[:-1]] + [(0, parts[-1])]
+
+
+def file_stat(f):
+    # Path string and stat result cached by `os.DirEntry` if any.
+    if isinstance(f, os.DirEntry):
+        return f.path, f.stat()
+    return f, None
+
+
+def filehash(path, algorithm=DEFAULT_HASH_ALGORITHM,
+             buffer_size=DEFAULT_HASH_BUFFER_SIZE):
+    '''Calculate hash value of the file.
+    The file is read into a reused buffer, which `hashlib` updates without
+    GIL on large chunks. It is not mapped on memory, where a file truncated
+    while hashing kills the process by SIGBUS.
+    '''
+    import hashlib
+    h = hashlib.new(algorithm)
+    with open(path, 'rb', buffering=0) as fp:
+        buf = bytearray(buffer_size)
+        view = memoryview(buf)
+        for n in iter(partial(fp.readinto, buf), 0):
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def fingerprint(path, algorithm=DEFAULT_HASH_ALGORITHM,
+                sample_size=FINGERPRINT_SAMPLE_SIZE):
+    '''Calculate hash value of the file size and the samples of `sample_size`
+    bytes at the head, middle and tail, which costs the same for any size.
+    Files of the same fingerprint are likely, not surely, the same.
+    '''
+    import hashlib
+    h = hashlib.new(algorithm)
+    with open(path, 'rb', buffering=0) as fp:
+        size = os.fstat(fp.fileno()).st_size
+        h.update('{}\n'.format(size).encode('ascii'))
+        for offset in (0, (size - sample_size) // 2, size - sample_size):
+            fp.seek(max(offset, 0))
+            h.update(fp.read(sample_size))
+    return h.hexdigest()
+
+
 def md5sum(path):
     # Calculate MD5 sum value.
-    chunk_size = 4096
-    md5 = hashlib.md5()
+    return filehash(path, 'md5')
+
+
+def timed_filehash(path, algorithm=DEFAULT_HASH_ALGORITHM):
+    # Hash value of the file and the seconds to calculate it.
+    t = time.perf_counter()
+    digest = filehash(path, algorithm)
+    return digest, time.perf_counter() - t
+
+
+def hash_files(paths, algorithm=DEFAULT_HASH_ALGORITHM, jobs=4,
+               needed=None):
+    '''Calculate hash values of files in threads, and yield tuples of
+    the path, the hash value and the seconds to calculate it in the same
+    order. If `needed` predicate returns False, they are None.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    pending = deque()
+    with ThreadPoolExecutor(jobs) as executor:
+        for path in paths:
+            future = None
+            if needed is None or needed(path):
+                future = executor.submit(timed_filehash, path, algorithm)
+            pending.append((path, future))
+            # Read ahead a little to keep threads busy.
+            if len(pending) > jobs * 2:
+                path, future = pending.popleft()
+                yield (path, ) + (future.result() if future else (None, None))
+        while pending:
+            path, future = pending.popleft()
+            yield (path, ) + (future.result() if future else (None, None))
+
+
+class HashingReader(io.RawIOBase):
+
+    '''Raw binary stream to calculate hash value of the bytes read through.
+    Wrap it by `io.BufferedReader` to read the file only once on processing.
+    The file object is not closed with this stream, so that `hexdigest()`
+    can read the rest after the processing.
+    '''
+
+    def __init__(self, fileobj, algorithm=DEFAULT_HASH_ALGORITHM):
+        import hashlib
+        self.raw = fileobj
+        self.hash = hashlib.new(algorithm)
+        # Seconds spent on hashing.
+        self.hash_time = 0.0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.raw.readinto(b)
+        if n:
+            t = time.perf_counter()
+            self.hash.update(memoryview(b)[:n])
+            self.hash_time += time.perf_counter() - t
+        return n
+
+    def tell(self):
+        return self.raw.tell()
+
+    def hexdigest(self):
+        # Consume the rest which is not read by the processing.
+        t = time.perf_counter()
+        buf = bytearray(DEFAULT_HASH_BUFFER_SIZE)
+        view = memoryview(buf)
+        for n in iter(partial(self.raw.readinto, buf), 0):
+            self.hash.update(view[:n])
+        digest = self.hash.hexdigest()
+        self.hash_time += time.perf_counter() - t
+        return digest
+
+
+class GzipPipeReader(io.RawIOBase):
+
+    '''Raw binary stream of gzip file decompressed by a background thread.
+    The thread inflates large blocks by `zlib`, which releases GIL, and passes
+    them through a bounded queue, so that the consumer processes the data
+    while the next blocks are decompressed.
+    '''
+
+    def __init__(self, path, fileobj=None, block_size=GZIP_BLOCK_SIZE,
+                 depth=GZIP_QUEUE_DEPTH, start=0, window=None, position=0,
+                 builder=None):
+        self.fileobj = fileobj or open(path, 'rb')
+        self.owned = fileobj is None
+        if start:
+            self.fileobj.seek(start)
+        # Inflate raw deflate stream with the window from a `GzipIndex`
+        # point in the middle of a gzip member.
+        self.window = window
+        # Find access points of `GzipIndexBuilder` on decompressing.
+        self.builder = builder
+        self.block_size = block_size
+        self.queue = queue.Queue(depth)
+        self.stopped = threading.Event()
+        self.buffer = memoryview(b'')
+        # Uncompressed offset of the start point, as `tell()` returns.
+        self.position = position
+        self.eof = False
+        self.thread = threading.Thread(target=self._inflate, daemon=True)
+        self.thread.start()
+
+    def _inflate(self):
+        try:
+            if self.builder is None:
+                blocks = self._decompress()
+            else:
+                blocks = self._build()
+            for out in blocks:
+                if not self._put(out):
+                    return
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def _decompress(self):
+        if self.window is None:
+            d = zlib.decompressobj(31)
+        else:
+            d = zlib.decompressobj(-15, zdict=self.window)
+        # Bytes of gzip trailer to skip after the raw deflate stream.
+        trailer = 0 if self.window is None else 8
+        read = partial(self.fileobj.read, self.block_size)
+        for data in iter(read, b''):
+            while data:
+                if d.eof and trailer:
+                    n = min(trailer, len(data))
+                    data, trailer = data[n:], trailer - n
+                    continue
+                if d.eof:
+                    # Next member, but skip zero padding as `gzip` does.
+                    data = data.lstrip(b'\0')
+                    if not data:
+                        break
+                    d = zlib.decompressobj(31)
+                # Limit the output not to fill memory by a large block.
+                out = d.decompress(data, self.block_size * 4)
+                if out:
+                    yield out
+                data = d.unused_data if d.eof else d.unconsumed_tail
+        if not d.eof:
+            raise EOFError('Compressed file ended before the '
+                           'end-of-stream marker was reached')
+
+    def _build(self):
+        read = partial(self.fileobj.read, self.block_size)
+        for block in iter(read, b''):
+            for out in self.builder.feed(block):
+                yield out
+        self.builder.close()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            if self.eof:
+                return 0
+            item = self.queue.get()
+            if item is None or isinstance(item, Exception):
+                self.eof = True
+                if item is None:
+                    return 0
+                raise item
+            self.buffer = memoryview(item)
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        self.position += n
+        return n
+
+    def tell(self):
+        # Position in the decompressed data.
+        return self.position
+
+    def close(self):
+        if self.closed:
+            return
+        self.stopped.set()
+        self.thread.join()
+        if self.owned:
+            self.fileobj.close()
+        super().close()
+
+
+class OutputWriter(object):
+
+    '''Text output file written on a background thread.
+
+    Text is buffered up to `buffer_size` characters, and passed to the
+    thread through a bounded queue of `depth` buffers, which encodes,
+    compresses by gzip if the path ends with ".gz", and writes them. The
+    caller blocks only when the thread falls behind by the whole queue.
+    If `partition` is given, output is split into the files numbered like
+    "output-00001.csv.gz". "input" starts a new file on `next_input()` for
+    each input file, and a number N starts one after N lines, counted at the
+    end of `write()` calls not to split a record written at once.
+    '''
+
+    def __init__(self, path, encoding, buffer_size=OUTPUT_BUFFER_SIZE,
+                 depth=OUTPUT_QUEUE_DEPTH, partition=None):
+        self.logger = logging.getLogger(APPNAME + '.output')
+        self.path = path
+        self.encoding = encoding
+        self.buffer_size = buffer_size
+        self.partition = partition
+        self.buffer = []
+        self.buffered = 0
+        self.rows = 0
+        # Number of the partition files, which are opened on first write.
+        self.count = 0
+        self.opened = False
+        self.closed = False
+        self.error = None
+        fp = None
+        if not partition:
+            # Open here to raise the error to the caller at once.
+            fp = self._open_file(path)
+            self.opened = True
+        self.queue = queue.Queue(depth)
+        self.thread = threading.Thread(target=self._write, args=(fp, ),
+                                       daemon=True)
+        self.thread.start()
+
+    def partition_path(self, n):
+        base, ext = os.path.splitext(self.path)
+        if ext == '.gz':
+            base, inner = os.path.splitext(base)
+            ext = inner + ext
+        return '{}-{:05d}{}'.format(base, n, ext)
+
+    def _open_file(self, path):
+        if path.endswith('.gz'):
+            import gzip
+            return gzip.open(path, 'wt', compresslevel=6,
+                             encoding=self.encoding)
+        return open(path, 'w', encoding=self.encoding)
+
+    def _write(self, fp):
+        try:
+            for kind, value in iter(self.queue.get, None):
+                if kind == 'write':
+                    fp.write(value)
+                    continue
+                if kind == 'sync':
+                    try:
+                        if fp:
+                            fp.flush()
+                    except Exception as e:
+                        # Set before waking up the caller to check it.
+                        self.error = e
+                        raise
+                    finally:
+                        value.set()
+                    continue
+                if fp:
+                    fp.close()
+                fp = self._open_file(value)
+        except Exception as e:
+            self.error = e
+            # Keep the caller from blocking on the full queue or a sync.
+            for kind, value in iter(self.queue.get, None):
+                if kind == 'sync':
+                    value.set()
+        finally:
+            # Buffered output is written on closing, which may fail, too.
+            try:
+                if fp:
+                    fp.close()
+            except Exception as e:
+                self.error = self.error or e
+
+    def check(self):
+        '''Raise the error of the thread, if any, e.g. before recording the
+        inputs written so far as processed.
+        '''
+        if self.error:
+            raise self.error
+
+    def sync(self):
+        '''Wait for the thread to write all the output so far to the file,
+        and raise the error if any, e.g. before committing the records of
+        the inputs.
+        '''
+        if self.closed:
+            # All written by `close()`.
+            self.check()
+            return
+        self.flush()
+        done = threading.Event()
+        self._put(('sync', done))
+        done.wait()
+        self.check()
+
+    def _put(self, item):
+        self.check()
+        self.queue.put(item)
+
+    def _open(self):
+        # Partition files are opened on the thread.
+        self.count += 1
+        path = self.partition_path(self.count)
+        self.logger.info('Write output partition: %s', path)
+        self._put(('open', path))
+        self.opened = True
+        self.rows = 0
+
+    def write(self, s):
+        if not self.opened:
+            self._open()
+        self.buffer.append(s)
+        self.buffered += len(s)
+        if self.partition and self.partition != 'input':
+            self.rows += s.count('\n')
+            if self.rows >= self.partition:
+                # Next write goes to the next partition.
+                self.flush()
+                self.opened = False
+                return len(s)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+        return len(s)
+
+    def next_input(self):
+        '''Start a new partition for the next input, if partitioned so.'''
+        if self.partition == 'input' and self.opened:
+            self.flush()
+            self.opened = False
+
+    def flush(self):
+        if self.buffer:
+            self._put(('write', ''.join(self.buffer)))
+            self.buffer = []
+            self.buffered = 0
+
+    def isatty(self):
+        return False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.flush()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+        if self.error:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def partition_type(value):
+    '''Parse `--output-partition` of "input" or a number of rows.'''
+    if value == 'input':
+        return value
+    try:
+        n = int(value)
+    except ValueError:
+        n = 0
+    if n <= 0:
+        raise argparse.ArgumentTypeError('invalid partition: ' + value)
+    return n
+
+
+def open_input(path, encoding, fileobj=None, pipeline=False, builder=None):
+    # Open input file as text, decompress gzip file by its extension.
+    # If `fileobj` is given, read it instead of opening `path`.
+    # If `builder` is given, find gzip access points on the same pass.
+    _, suffix = os.path.splitext(path)
+    if suffix == '.gz':
+        if pipeline or builder is not None:
+            return io.TextIOWrapper(io.BufferedReader(
+                GzipPipeReader(path, fileobj, builder=builder)),
+                encoding=encoding)
+        import gzip
+        return gzip.open(fileobj or path, 'rt', encoding=encoding)
+    if fileobj:
+        return io.TextIOWrapper(fileobj, encoding=encoding)
+    return open(path, 'r', encoding=encoding)
+
+
+class RangeReader(io.RawIOBase):
+
+    '''Raw binary stream to read the byte range of a file.'''
+
+    def __init__(self, path, start, end):
+        self.raw = open(path, 'rb', buffering=0)
+        self.raw.seek(start)
+        self.start = start
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.remaining <= 0:
+            return 0
+        with memoryview(b) as view:
+            n = self.raw.readinto(view[:self.remaining])
+        self.remaining -= n
+        return n
+
+    def tell(self):
+        # Position in the range.
+        return self.raw.tell() - self.start
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+class LineRangeReader(io.RawIOBase):
+
+    '''Raw binary stream of the lines which start in the first `limit` bytes
+    of the stream. If `skip` is True, the first partial line is skipped as
+    it belongs to the previous range.
+    '''
+
+    def __init__(self, raw, skip, limit=None):
+        self.raw = raw
+        self.skip = skip
+        self.limit = limit
+        self.pos = 0
+        self.returned = 0
+        self.at_line_head = True
+        self.done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._read(len(b))
+        n = len(data)
+        b[:n] = data
+        self.returned += n
+        return n
+
+    def tell(self):
+        # Bytes of the lines in the range read so far.
+        return self.returned
+
+    def _read(self, size):
+        while not self.done:
+            data = self.raw.read(size)
+            if not data:
+                self.done = True
+                break
+            pos, self.pos = self.pos, self.pos + len(data)
+            if self.skip:
+                i = data.find(b'\n')
+                if i < 0:
+                    continue
+                self.skip = False
+                data, pos = data[i + 1:], pos + i + 1
+            if self.limit is None or self.pos < self.limit:
+                if data:
+                    self.at_line_head = data.endswith(b'\n')
+                    return data
+                continue
+            # Stop at the end of the line over the limit.
+            k = max(self.limit - pos, 0)
+            if k == 0 and self.at_line_head:
+                self.done = True
+                break
+            i = data.find(b'\n', k - 1 if k > 0 else 0)
+            if i >= 0:
+                self.done = True
+                return data[:i + 1]
+            self.at_line_head = False
+            if data:
+                return data
+        return b''
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+def split_chunks(path, chunk_size):
+    '''Split a file into byte ranges of about `chunk_size` bytes at line
+    boundaries, and return the list of (start, end) tuples.
+    '''
+    size = os.path.getsize(path)
+    bounds = [0]
     with open(path, 'rb') as fp:
-        for buf in iter(partial(fp.read, chunk_size), b''):
-            md5.update(buf)
-    return md5.hexdigest()
+        while bounds[-1] + chunk_size < size:
+            # Move to the next line unless the position is at the head.
+            fp.seek(bounds[-1] + chunk_size - 1)
+            fp.readline()
+            if fp.tell() >= size:
+                break
+            bounds.append(fp.tell())
+    bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+
+def open_binary(path, fileobj=None, pipeline=False, builder=None):
+    # Open input file as binary, decompress gzip file by its extension.
+    # The file is not mapped on memory, where truncating it while reading
+    # kills the process by SIGBUS.
+    _, suffix = os.path.splitext(path)
+    if suffix == '.gz':
+        if pipeline or builder is not None:
+            return GzipPipeReader(path, fileobj, builder=builder)
+        import gzip
+        return gzip.GzipFile(path if fileobj is None else None, 'rb',
+                             fileobj=fileobj)
+    if fileobj:
+        return fileobj
+    return open(path, 'rb')
+
+
+def skip_bytes(fp, n):
+    # Move the binary stream forward, gzip file is decompressed to skip
+    # from the position it starts at, e.g. the access point of `GzipIndex`.
+    if fp.seekable():
+        fp.seek(n)
+        return
+    n -= fp.tell()
+    buf = bytearray(SCAN_BLOCK_SIZE)
+    while n > 0:
+        k = fp.readinto(memoryview(buf)[:min(n, len(buf))])
+        if not k:
+            break
+        n -= k
+
+
+def ascii_compatible(encoding):
+    # Whether lines can be counted on bytes encoded by the encoding.
+    return '\r\n'.encode(encoding) == b'\r\n'
+
+
+def stream_position(fp):
+    # Bytes read from the (decompressed) input stream, if it can tell.
+    if isinstance(fp, io.TextIOWrapper):
+        fp = fp.buffer
+    if isinstance(fp, io.BufferedReader):
+        fp = fp.raw
+    try:
+        return fp.tell()
+    except (OSError, ValueError):
+        return None
+
+
+def run_app(app, fp, header, binary, opened_at, resume=None):
+    '''Process opened `fp` by `App.scan()` if `binary`, or `App.process()`.
+    Only `App.scan()` continues from the checkpoint `resume`.
+    Return the result and the stats of the seconds to open and process,
+    and the bytes read.
+    '''
+    t = time.perf_counter()
+    if binary:
+        r = app.scan(fp, header, resume)
+    else:
+        r = app.process(fp, header)
+    stats = {
+        'open_time': t - opened_at,
+        'process_time': time.perf_counter() - t,
+        'bytes_read': stream_position(fp),
+    }
+    return r, stats
+
+
+def merge_stats(stats):
+    '''Merge stats of the chunks of a file into one by summing up.'''
+    merged = {}
+    for st in stats:
+        for k, v in st.items():
+            if v is not None:
+                merged[k] = merged.get(k, 0) + v
+    return merged
+
+
+def process_path(app, path, encoding, header, algorithm=None,
+                 pipeline=False, resume=None, builder=None, points=None):
+    '''Process an input file by `App.process()`, or `App.scan()` on bytes
+    if the application does not need decoded text.
+    If hash `algorithm` is given, calculate the hash value on the same pass.
+    If `pipeline` is True, decompress gzip file on a background thread.
+    If `resume` checkpoint is given, `App.scan()` continues from it, and
+    gzip file is decompressed from the nearest of access `points`, if any.
+    If `builder` is given, find gzip access points on the same pass.
+    Return the result, the hash value and the stats of `run_app()`.
+    '''
+    binary = not app.needs_text and ascii_compatible(encoding)
+    t = time.perf_counter()
+    if algorithm is None:
+        if binary:
+            if resume and points:
+                # `App.scan()` reads the byte before the checkpoint.
+                fp = GzipIndex.open(path, points, resume[0] - 1)
+            else:
+                fp = open_binary(path, pipeline=pipeline, builder=builder)
+            with fp:
+                r, stats = run_app(app, fp, header, True, t, resume)
+        else:
+            with open_input(path, encoding, pipeline=pipeline,
+                            builder=builder) as fp:
+                r, stats = run_app(app, fp, header, False, t)
+        return r, None, stats
+    with open(path, 'rb', buffering=0) as f:
+        raw = HashingReader(f, algorithm)
+        if binary:
+            with open_binary(path, io.BufferedReader(raw), pipeline,
+                             builder) as fp:
+                r, stats = run_app(app, fp, header, True, t)
+        else:
+            with open_input(path, encoding, io.BufferedReader(raw),
+                            pipeline, builder) as fp:
+                r, stats = run_app(app, fp, header, False, t)
+        # Hashing on reading is not a part of the processing.
+        stats['process_time'] -= raw.hash_time
+        # Background thread, if any, has stopped reading the file here.
+        digest = raw.hexdigest()
+        stats['hash_time'] = raw.hash_time
+        return r, digest, stats
+
+
+def process_range(app, path, encoding, header, start, end):
+    '''Process the byte range of an uncompressed file split by
+    `split_chunks()`. Header line is only in the first range.
+    '''
+    header = header and start == 0
+    binary = not app.needs_text and ascii_compatible(encoding)
+    t = time.perf_counter()
+    with RangeReader(path, start, end) as raw:
+        if binary:
+            r, stats = run_app(app, raw, header, True, t)
+        else:
+            with io.TextIOWrapper(io.BufferedReader(raw),
+                                  encoding=encoding) as fp:
+                r, stats = run_app(app, fp, header, False, t)
+    return r, None, stats
+
+
+def process_gzip_range(app, path, encoding, header, point, limit=None):
+    '''Process the lines of a gzip file which start in `limit` bytes from
+    the access point of `GzipIndex`. Header line is only in the first range.
+    '''
+    compressed, uncompressed, kind, window = point
+    first = uncompressed == 0
+    binary = not app.needs_text and ascii_compatible(encoding)
+    t = time.perf_counter()
+    raw = GzipPipeReader(path, start=compressed,
+                         window=window if kind == 'flush' else None)
+    skip = not first and not window.endswith(b'\n')
+    header = header and first
+    with LineRangeReader(raw, skip, limit) as reader:
+        if binary:
+            r, stats = run_app(app, reader, header, True, t)
+        else:
+            with io.TextIOWrapper(io.BufferedReader(reader),
+                                  encoding=encoding) as fp:
+                r, stats = run_app(app, fp, header, False, t)
+    return r, None, stats
 
 
 class ConfigLoader(object):
@@ -238,9 +1344,11 @@ class ConfigLoader(object):
     def _load(self, extension):
         self.logger.debug('Config file extension is "%s".', extension)
         if extension == '.json':
+            import json
             with open(self.path, encoding=CONFIG_FILE_ENCODING) as fp:
                 return json.load(fp)
         elif extension in (".ini", ".cfg"):
+            import configparser
             parser = configparser.SafeConfigParser()
             with open(self.path, encoding=CONFIG_FILE_ENCODING) as fp:
                 parser.readfp(fp)
@@ -282,22 +1390,143 @@ class ProgressMonitor(object):
              'constraints': {'required': True}},
             {'name': 'size', 'type': 'integer',
              'constraints': {'required': True}},
+            {'name': 'mtime_ns', 'type': 'integer'},
+            {'name': 'inode', 'type': 'integer'},
             {'name': 'start_at', 'type': 'float',
              'constraints': {'required': True}},
             {'name': 'finish_at', 'type': 'float'},
             {'name': 'digest', 'type': 'string',
              'constraints': {'required': True, 'unique': True}},
+            # "full" or "sample" by `fingerprint()`, NULL is "full".
+            {'name': 'digest_type', 'type': 'string'},
             {'name': 'result', 'type': 'string'},  # Anything encoded by JSON
+            # Performance stats of each stage.
+            {'name': 'hash_time', 'type': 'float'},
+            {'name': 'open_time', 'type': 'float'},
+            {'name': 'process_time', 'type': 'float'},
+            {'name': 'bytes_read', 'type': 'integer'},
+            {'name': 'throughput', 'type': 'float'},  # bytes/sec
+            # Progress saved by `App` to resume the file after a crash.
+            {'name': 'checkpoint_offset', 'type': 'integer'},
+            {'name': 'checkpoint_lines', 'type': 'integer'},
+            {'name': 'checkpoint_result', 'type': 'string'},
         ),
         'primaryKey': ['seq']
     }
 
-    def __init__(self, db, dump=None):
+    def __init__(self, db, dump=None, verify_digest=False,
+                 algorithm=DEFAULT_HASH_ALGORITHM,
+                 commit_every=DEFAULT_COMMIT_EVERY,
+                 commit_interval=DEFAULT_COMMIT_INTERVAL,
+                 journal_mode=DEFAULT_JOURNAL_MODE, fingerprint_size=0,
+                 upgrade_digest=False):
         self.logger = logging.getLogger(APPNAME + '.monitor')
         self.db = db
+        if journal_mode:
+            self.set_journal_mode(journal_mode)
         self.create_table()
+        self.prepare()
         self.dump = dump
+        self.verify_digest = verify_digest
+        self.algorithm = algorithm
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.uncommitted = 0
+        self.committed_at = time.monotonic()
         self.current = None
+        self.deferred = {}
+        # Files larger than this are identified by `fingerprint()`.
+        self.fingerprint_size = fingerprint_size
+        self.upgrade_digest = upgrade_digest
+        self.upgrader = None
+        self.upgrades = deque()
+        # Records started before are unfinished by a crash, if not finished.
+        self.opened_at = time.time()
+        self.resume = None
+        # Called before every commit, e.g. to write the output of the files
+        # to record as processed.
+        self.before_commit = None
+
+    def set_journal_mode(self, journal_mode):
+        cur = self.db.cursor()
+        cur.execute('PRAGMA journal_mode = {}'.format(journal_mode))
+        mode = cur.fetchone()[0]
+        if mode.upper() == 'WAL':
+            # Commit is durable enough without syncing on every transaction.
+            cur.execute('PRAGMA synchronous = NORMAL')
+        cur.close()
+        self.logger.debug('Journal mode: %s', mode)
+
+    def prepare(self):
+        # Build SQL statements once, `sqlite3` reuses compiled statements.
+        t = ProgressMonitor.TABLE_NAME
+        columns = ('seq,path,size,start_at,finish_at,digest_type,'
+                   'checkpoint_offset,checkpoint_lines,checkpoint_result,'
+                   'digest')
+        self.sql = {
+            'lookup': 'SELECT {} FROM {} WHERE path = ? AND size = ? AND '
+                      'mtime_ns = ? AND inode = ?'.format(columns, t),
+            'digest': 'SELECT {} FROM {} WHERE digest = ?'.format(columns, t),
+            'start': 'INSERT INTO {} (path,size,mtime_ns,inode,start_at,'
+                     'digest,digest_type,hash_time) '
+                     'VALUES (?,?,?,?,?,?,?,?)'.format(t),
+            'settle': 'INSERT INTO {} (path,size,mtime_ns,inode,start_at,'
+                      'finish_at,digest,result,hash_time,open_time,'
+                      'process_time,bytes_read,throughput) '
+                      'VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)'.format(t),
+            'finish': 'UPDATE {} SET finish_at = ?, result = ?, '
+                      'open_time = ?, process_time = ?, bytes_read = ?, '
+                      'throughput = ? WHERE seq = ?'.format(t),
+            'touch': 'UPDATE {} SET size = ?, mtime_ns = ?, inode = ? '
+                     'WHERE seq = ?'.format(t),
+            'upgrade': 'UPDATE {} SET digest = ?, digest_type = ? '
+                       'WHERE seq = ?'.format(t),
+            'checkpoint': 'UPDATE {} SET checkpoint_offset = ?, '
+                          'checkpoint_lines = ?, checkpoint_result = ? '
+                          'WHERE digest = ?'.format(t),
+        }
+        self.cursor = self.db.cursor()
+
+    def execute(self, name, values):
+        q = self.sql[name]
+        self.logger.debug('Execute "%s": %s; %s', name, q, values)
+        return self.cursor.execute(q, values)
+
+    def tick(self):
+        # Group commit every N files or T seconds to keep the progress.
+        if self.upgrades:
+            self.upgrade()
+        self.uncommitted += 1
+        if self.commit_every and self.uncommitted >= self.commit_every:
+            self.commit()
+        elif (self.commit_interval and
+              time.monotonic() - self.committed_at >= self.commit_interval):
+            self.commit()
+
+    def commit(self):
+        if self.before_commit:
+            self.before_commit()
+        self.db.commit()
+        self.logger.debug('Commit %d records.', self.uncommitted)
+        self.uncommitted = 0
+        self.committed_at = time.monotonic()
+
+    @staticmethod
+    def column_definition(field, constraints=True):
+        # Pattern mapping against JSON Table Schema
+        t = 'TEXT'
+        if field['type'] == 'integer':
+            t = 'INTEGER'
+        elif field['type'] == 'float':
+            t = 'REAL'
+        f = '{} {}'.format(field['name'], t)
+        c = field.get('constraints')
+        if c and constraints:
+            if c.get('required'):
+                f += ' NOT NULL'
+            if c.get('unique'):
+                f += ' UNIQUE'
+        return f
 
     def create_table(self):
         # Check whether monitor table already exists.
@@ -308,23 +1537,10 @@ class ProgressMonitor(object):
         if r:
             self.logger.info('Monitor table is already created.')
             self.logger.debug(r[0])
+            self.migrate_table()
             return
-        d = []
-        # Pattern mapping against JSON Table Schema
-        for s in ProgressMonitor.SCHEMA['fields']:
-            t = 'TEXT'
-            if s['type'] == 'integer':
-                t = 'INTEGER'
-            elif s['type'] == 'float':
-                t = 'REAL'
-            f = '{} {}'.format(s['name'], t)
-            c = s.get('constraints')
-            if c:
-                if c.get('required'):
-                    f += ' NOT NULL'
-                if c.get('unique'):
-                    f += ' UNIQUE'
-            d.append(f)
+        d = [self.column_definition(s)
+             for s in ProgressMonitor.SCHEMA['fields']]
         f = 'PRIMARY KEY ('
         f += ','.join(k for k in ProgressMonitor.SCHEMA['primaryKey'])
         f += ')'
@@ -335,39 +1551,166 @@ class ProgressMonitor(object):
         cur = self.db.cursor()
         cur.execute(ddl)
         cur.close()
+        self.create_index()
         self.logger.info('Created monitor table.')
 
-    def terminate(self, fields):
+    def migrate_table(self):
+        # Add columns which are defined after the table was created.
+        cur = self.db.cursor()
+        cur.execute('PRAGMA table_info({})'.format(ProgressMonitor.TABLE_NAME))
+        columns = set(r[1] for r in cur)
+        for s in ProgressMonitor.SCHEMA['fields']:
+            if s['name'] in columns:
+                continue
+            ddl = """ALTER TABLE {} ADD COLUMN {}""".format(
+                ProgressMonitor.TABLE_NAME,
+                self.column_definition(s, constraints=False))
+            self.logger.info('Add monitor column: %s', ddl)
+            cur.execute(ddl)
+        cur.close()
+        self.create_index()
+
+    def create_index(self):
+        # Index to skip unchanged files by their stat values.
+        ddl = """CREATE INDEX IF NOT EXISTS {0}_path ON {0} (path)""".format(
+            ProgressMonitor.TABLE_NAME)
+        cur = self.db.cursor()
+        cur.execute(ddl)
+        cur.close()
+
+    SUMMARY_TABLE_NAME = '_summary'
+
+    def save_summary(self, counter):
+        '''Save counters of the run to merge shards.'''
+        cur = self.db.cursor()
+        table = ProgressMonitor.SUMMARY_TABLE_NAME
+        cur.execute('CREATE TABLE IF NOT EXISTS {} '
+                    '(key TEXT PRIMARY KEY, value INTEGER)'.format(table))
+        cur.executemany('INSERT OR REPLACE INTO {} VALUES (?,?)'.format(
+            table), sorted(counter.items()))
+        cur.close()
+
+    @staticmethod
+    def load_summary(db):
+        import sqlite3
+        cur = db.cursor()
+        try:
+            cur.execute('SELECT key, value FROM {}'.format(
+                ProgressMonitor.SUMMARY_TABLE_NAME))
+            return Counter(dict(cur))
+        except sqlite3.OperationalError:
+            # Not saved by the run.
+            return Counter()
+        finally:
+            cur.close()
+
+    ORDER_TABLE_NAME = '_order'
+
+    def save_order(self, order):
+        '''Save (path, position) pairs of the files in a shard, numbered in
+        the order of all the inputs, to merge shards in the order.
+        '''
+        cur = self.db.cursor()
+        table = ProgressMonitor.ORDER_TABLE_NAME
+        cur.execute('CREATE TABLE IF NOT EXISTS {} '
+                    '(path TEXT PRIMARY KEY, position INTEGER)'.format(table))
+        cur.executemany('INSERT OR REPLACE INTO {} VALUES (?,?)'.format(
+            table), order)
+        cur.close()
+
+    @staticmethod
+    def load_order(db):
+        import sqlite3
+        cur = db.cursor()
+        try:
+            cur.execute('SELECT path, position FROM {}'.format(
+                ProgressMonitor.ORDER_TABLE_NAME))
+            return dict(cur)
+        except sqlite3.OperationalError:
+            # Not saved by the run.
+            return {}
+        finally:
+            cur.close()
+
+    # Dump fields derived from the monitor columns.
+    DERIVED_FIELDS = {
+        'basename': ('path', ),
+        'extension': ('path', ),
+        'elapsed': ('start_at', 'finish_at'),
+    }
+
+    def terminate(self, fields, since=None):
+        '''Dump monitor records whose seq is greater than `since` if given.
+        The dump file is compressed if its name ends with ".gz".
+        Return the number of dumped records.
+        '''
         if self.dump is None:
             return
+        import csv
+        import gzip
         if os.path.isfile(self.dump):
             self.logger.warn('Overwrite dump file: %s', self.dump)
         self.logger.info('Dump monitor records as tab-delimited values.')
-        fp = open(self.dump, 'w')
-        writer = csv.writer(fp, delimiter='\t', lineterminator='\n')
-        columns = [f['name'] for f in ProgressMonitor.SCHEMA['fields']]
-        q = 'SELECT {} FROM {} ORDER BY seq'.format(
+        # Select the columns to dump, and decode results only if necessary.
+        names = set(f['name'] for f in fields)
+        schema = [f['name'] for f in ProgressMonitor.SCHEMA['fields']]
+        needed = set(['seq'])
+        for name in names:
+            if name in ProgressMonitor.DERIVED_FIELDS:
+                needed.update(ProgressMonitor.DERIVED_FIELDS[name])
+            elif name in schema:
+                needed.add(name)
+            else:
+                needed.add('result')
+        columns = [c for c in schema if c in needed]
+        q = 'SELECT {} FROM {} WHERE seq > ? ORDER BY seq'.format(
             ','.join(columns), ProgressMonitor.TABLE_NAME)
         cur = self.db.cursor()
-        cur.execute(q)
+        cur.execute(q, (since or 0, ))
+        rows = chain.from_iterable(
+            iter(partial(cur.fetchmany, DUMP_BATCH_SIZE), []))
         dumper = Tabular(fields)
-        writer.writerow(dumper.header())
-        for r in cur:
-            t = dict(zip(columns, r))
-            t['path'] = t['path'].replace('\\', '/')
-            t['basename'] = os.path.basename(t['path'])
-            t['extension'] = os.path.splitext(t['path'])[-1].lower()
-            if t['finish_at'] is not None:
-                t['elapsed'] = t['finish_at'] - t['start_at']
-                t['finish_at'] = datetime.datetime.fromtimestamp(t['finish_at'])
-            t['start_at'] = datetime.datetime.fromtimestamp(t['start_at'])
-            if t['result']:
-                result = json.loads(t['result'])
-                for k in result:
-                    t[k] = result[k]
-            writer.writerow(dumper(t))
+        counter = Counter()
+        if self.dump.endswith('.gz'):
+            fp = gzip.open(self.dump, 'wt', compresslevel=6,
+                           encoding=DEFAULT_OUTPUT_FILE_ENCODING, newline='')
+        else:
+            fp = open(self.dump, 'w', buffering=DUMP_BUFFER_SIZE,
+                      encoding=DEFAULT_OUTPUT_FILE_ENCODING, newline='')
+        with fp:
+            writer = csv.writer(fp, delimiter='\t', lineterminator='\n')
+            writer.writerow(dumper.header())
+            writer.writerows(dumper.encode_many(
+                self._dump_records(rows, columns, names, counter)))
         cur.close()
-        fp.close()
+        self.logger.info('Dumped {:,} records up to seq {}.'.format(
+            counter['records'], counter['seq'] or since or 0))
+        return counter['records']
+
+    @staticmethod
+    def _dump_records(rows, columns, names, counter):
+        import datetime
+        import json
+        fromtimestamp = datetime.datetime.fromtimestamp
+        for r in rows:
+            t = dict(zip(columns, r))
+            if 'path' in t:
+                t['path'] = t['path'].replace('\\', '/')
+                if 'basename' in names:
+                    t['basename'] = os.path.basename(t['path'])
+                if 'extension' in names:
+                    t['extension'] = os.path.splitext(t['path'])[-1].lower()
+            if t.get('finish_at') is not None:
+                if 'elapsed' in names:
+                    t['elapsed'] = t['finish_at'] - t['start_at']
+                t['finish_at'] = fromtimestamp(t['finish_at'])
+            if t.get('start_at') is not None:
+                t['start_at'] = fromtimestamp(t['start_at'])
+            if t.get('result'):
+                t.update(json.loads(t['result']))
+            counter['records'] += 1
+            counter['seq'] = t['seq']
+            yield t
 
     def fetch_one(self, columns, conditions, table=None):
         # It's okay `columns` is string or list.
@@ -391,67 +1734,519 @@ class ProgressMonitor(object):
         cur.close()
         return r
 
-    def start(self, path):
-        md5 = md5sum(path)
-        r = self.fetch_one(['seq', 'path', 'size', 'start_at', 'finish_at'], (
-            ('digest', '=', md5),
-        ))
+    def start(self, path, digest=None, st=None, hash_time=None):
+        st = st or os.stat(path)
+        self.resume = None
+        if digest is None and not self.verify_digest:
+            r = self.lookup(path, st)
+            if r and self.restart(r):
+                return
+            if r:
+                self.logger.info('Already processed "%s": [%s] %s -> %s',
+                                 r[1], r[0], r[2], r[3])
+                return r
+        md5, digest_type = digest, 'full'
+        if md5 is None:
+            t = time.perf_counter()
+            if self.sampled(path, st):
+                md5, digest_type = fingerprint(path, self.algorithm), 'sample'
+            else:
+                md5 = filehash(path, self.algorithm)
+            hash_time = time.perf_counter() - t
+        r = self.execute('digest', (md5, )).fetchone()
+        if r and digest_type == 'sample' and r[1] != path:
+            # Same samples of another file, compare the full digests.
+            t = time.perf_counter()
+            self.upgrade_record(r)
+            md5, digest_type = filehash(path, self.algorithm), 'full'
+            hash_time += time.perf_counter() - t
+            r = self.execute('digest', (md5, )).fetchone()
+        if r and self.restart(r):
+            return
         if r:
-            msg = 'Already processed "{}": [{}] {} -> {}'
-            self.logger.info(msg.format(r[1], r[0], r[2], r[3]))
+            self.logger.info('Already processed "%s": [%s] %s -> %s',
+                             r[1], r[0], r[2], r[3])
+            if r[1] == path:
+                # Not to calculate hash value again on the next run.
+                self.touch(r[0], st)
             return r
-        size = os.path.getsize(path)
-        self.logger.info('Start monitoring: {} ({}) {:,}bytes'.format(
-                         path, md5, size))
-        columns = ('path', 'size', 'start_at', 'digest')
-        values = (path, size, time.time(), md5)
-        q = """INSERT INTO {} ({}) VALUES ({})""".format(
-            ProgressMonitor.TABLE_NAME,
-            ','.join(columns),
-            ','.join(['?' for i in range(len(values))])
-            )
-        self.logger.debug('Insert one record: %s; %s', q, values)
-        cur = self.db.cursor()
-        cur.execute(q, values)
-        cur.close()
+        self.logger.info('Start monitoring: %s (%s) %dbytes', path, md5,
+                         st.st_size)
+        self.execute('start', (path, st.st_size, st.st_mtime_ns, st.st_ino,
+                               time.time(), md5, digest_type, hash_time))
         self.current = md5
 
-    def finish(self, result=None):
-        if self.current is None:
-            self.logger.fatal('Monitor nothing, but `finish()` is called.')
-            return
-        r = self.fetch_one(['seq', 'path', 'start_at'], (
-            ('digest', '=', self.current),
-        ))
-        if r is None:
-            self.logger.fatal('Monitor "%s", but removed.', self.current)
-            return
-        now = time.time()
-        if result:
-            values = (now, json.dumps(result), r[0])
-            columns = ('finish_at = ?', 'result = ?')
+    def unfinished(self, r):
+        # Whether the record is left unfinished by a previous run.
+        return r[4] is None and r[3] < self.opened_at
+
+    def restart(self, r):
+        '''Make the record unfinished by a previous run current to process
+        again, from the last checkpoint if any. Return True if restarted.
+        '''
+        if not self.unfinished(r):
+            return False
+        import json
+        self.current = r[9]
+        if r[6]:
+            self.resume = (r[6], r[7],
+                           json.loads(r[8]) if r[8] else None)
+            self.logger.info('Resume from checkpoint: %s [%s] at %dbytes '
+                             '%dlines', r[1], r[0], r[6], r[7])
         else:
-            values = (now, r[0])
-            columns = ('finish_at = ?', )
-        q = """UPDATE {} SET {} WHERE seq = ?""".format(
-            ProgressMonitor.TABLE_NAME,
-            ','.join(columns)
-            )
-        self.logger.debug('Update one record: %s; %s', q, values)
-        cur = self.db.cursor()
-        cur.execute(q, values)
-        cur.close()
-        self.current = None
-        self.logger.info('Finish processing: {} [{}] {:,.03f}sec'.format(
-            r[1], r[0], now - r[2]))
+            self.logger.info('Restart unfinished: %s [%s]', r[1], r[0])
+        return True
 
+    def checkpoint(self, offset, lines, result=None):
+        '''Save the progress of the current file, and commit it at once.
+        `offset` is the position of the input bytes to resume from.
+        '''
+        import json
+        self.execute('checkpoint', (offset, lines,
+                                    json.dumps(result) if result else None,
+                                    self.current))
+        self.commit()
+        self.logger.debug('Checkpoint: %s at %d bytes', self.current, offset)
 
-class Tabular(object):
+    def sampled(self, path, st=None):
+        # Whether the file is identified by `fingerprint()`.
+        if not self.fingerprint_size:
+            return False
+        return (st or os.stat(path)).st_size > self.fingerprint_size
 
-    '''JSON Table Schema based record class.
+    def upgrade_record(self, r):
+        '''Replace the fingerprint of the record `r` by the full digest, if
+        the file is still there as recorded.
+        '''
+        path, size = r[1], r[2]
+        if not (os.path.isfile(path) and os.path.getsize(path) == size):
+            self.logger.info('Cannot upgrade digest of changed file: %s', path)
+            return
+        self.set_digest(r[0], path, filehash(path, self.algorithm))
 
-    FIELDS = (
-        {'name': 'id', 'type': 'string'},
+    def set_digest(self, seq, path, digest):
+        import sqlite3
+        try:
+            self.execute('upgrade', (digest, 'full', seq))
+        except sqlite3.IntegrityError:
+            # It is found late that the same contents are processed twice.
+            r = self.execute('digest', (digest, )).fetchone()
+            self.logger.warning('Same contents are processed: %s [%s] and '
+                                '%s [%s]', path, seq, r[1], r[0])
+            return
+        self.logger.info('Upgrade digest: %s [%s] (%s)', path, seq, digest)
+
+    def upgrade(self, wait=False):
+        '''Record full digests calculated in the background for the files
+        finished by fingerprints. Wait for all of them if `wait`.
+        '''
+        while self.upgrades and (wait or self.upgrades[0][2].done()):
+            seq, path, future = self.upgrades.popleft()
+            digest = future.result()
+            if digest is None:
+                self.logger.info('Cannot upgrade digest of changed file: %s',
+                                 path)
+                continue
+            self.set_digest(seq, path, digest)
+        if wait and self.upgrader:
+            self.upgrader.shutdown()
+            self.upgrader = None
+
+    def lookup(self, path, st=None):
+        # Cheap check whether the file is already processed without reading.
+        st = st or os.stat(path)
+        return self.execute('lookup', (path, st.st_size, st.st_mtime_ns,
+                                       st.st_ino)).fetchone()
+
+    def unchanged(self, path, st=None):
+        if self.verify_digest:
+            return False
+        r = self.lookup(path, st)
+        return r is not None and not self.unfinished(r)
+
+    def touch(self, seq, st):
+        self.execute('touch', (st.st_size, st.st_mtime_ns, st.st_ino, seq))
+        self.tick()
+
+    def defer(self, path, st=None):
+        '''Start monitoring without hash value, which is given on
+        `settle()` after the file is processed.
+        '''
+        st = st or os.stat(path)
+        if not self.verify_digest:
+            r = self.lookup(path, st)
+            if r and not self.unfinished(r):
+                self.logger.info('Already processed "%s": [%s] %s -> %s',
+                                 r[1], r[0], r[2], r[3])
+                return r
+        self.logger.info('Start monitoring: %s %dbytes', path, st.st_size)
+        self.deferred[path] = (st, time.time())
+
+    @staticmethod
+    def stat_values(stats):
+        # Column values of the stats given by `run_app()`.
+        stats = stats or {}
+        nbytes = stats.get('bytes_read')
+        elapsed = stats.get('open_time', 0) + stats.get('process_time', 0)
+        throughput = nbytes / elapsed if nbytes and elapsed > 0 else None
+        return (stats.get('open_time'), stats.get('process_time'), nbytes,
+                throughput)
+
+    def settle(self, path, digest, result=None, stats=None):
+        '''Record the file started by `defer()` at once.
+        Return False if the same contents are already processed.
+        '''
+        import json
+        st, start_at = self.deferred.pop(path)
+        r = self.execute('digest', (digest, )).fetchone()
+        if r and self.unfinished(r):
+            # Finish the record left by a previous run.
+            self.touch(r[0], st)
+            self.current = digest
+            self.finish(result, digest, stats)
+            return True
+        if r:
+            self.logger.info('Already processed "%s": [%s] (%s)', r[1], r[0],
+                             digest)
+            if r[1] == path:
+                self.touch(r[0], st)
+            return False
+        now = time.time()
+        self.execute('settle', (path, st.st_size, st.st_mtime_ns, st.st_ino,
+                                start_at, now, digest,
+                                json.dumps(result) if result else None,
+                                (stats or {}).get('hash_time')) +
+                     self.stat_values(stats))
+        self.tick()
+        self.logger.info('Finish processing: %s (%s) %.03fsec', path, digest,
+                         now - start_at)
+        return True
+
+    def detach(self):
+        '''Hand over the current record to finish it later by its digest.'''
+        current, self.current = self.current, None
+        return current
+
+    def _full_digest(self, path, size):
+        # Full digest in the background unless the file is changed.
+        if os.path.getsize(path) != size:
+            return None
+        return filehash(path, self.algorithm)
+
+    def finish(self, result=None, digest=None, stats=None):
+        import json
+        digest = digest or self.current
+        if digest is None:
+            self.logger.fatal('Monitor nothing, but `finish()` is called.')
+            return
+        r = self.execute('digest', (digest, )).fetchone()
+        if r is None:
+            self.logger.fatal('Monitor "%s", but removed.', digest)
+            return
+        now = time.time()
+        self.execute('finish', (now, json.dumps(result) if result else None) +
+                     self.stat_values(stats) + (r[0], ))
+        if r[5] == 'sample' and self.upgrade_digest:
+            if self.upgrader is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.upgrader = ThreadPoolExecutor(1)
+            self.upgrades.append((r[0], r[1], self.upgrader.submit(
+                self._full_digest, r[1], r[2])))
+        self.tick()
+        if digest == self.current:
+            self.current = None
+        self.logger.info('Finish processing: %s [%s] %.03fsec', r[1], r[0],
+                         now - r[3])
+
+
+class GzipIndex(object):
+
+    '''Access points of gzip files to decompress from the middle, as "zran.c"
+    of zlib does, keyed by the digest of the file.
+
+    Python `zlib` cannot start inflating at a bit offset. So the points are
+    only at gzip member boundaries, and at deflate blocks following a sync or
+    full flush (e.g. by `pigz` or `bgzip`), which start at a byte boundary.
+    A gzip file written in one stream has only the point at its head.
+    '''
+
+    TABLE_NAME = '_gzindex'
+    # Empty stored block emitted by a sync or full flush.
+    FLUSH_MARKER = b'\x00\x00\xff\xff'
+    WINDOW_SIZE = 32 * 1024
+
+    def __init__(self, db):
+        self.logger = logging.getLogger(APPNAME + '.gzindex')
+        self.db = db
+        ddl = """CREATE TABLE IF NOT EXISTS {} (
+            digest TEXT NOT NULL, point INTEGER NOT NULL,
+            compressed INTEGER NOT NULL, uncompressed INTEGER NOT NULL,
+            kind TEXT NOT NULL, window BLOB NOT NULL,
+            PRIMARY KEY (digest, point))""".format(GzipIndex.TABLE_NAME)
+        cur = self.db.cursor()
+        cur.execute(ddl)
+        cur.close()
+
+    def load(self, digest):
+        q = """SELECT compressed, uncompressed, kind, window FROM {}
+               WHERE digest = ? ORDER BY point""".format(GzipIndex.TABLE_NAME)
+        cur = self.db.cursor()
+        cur.execute(q, (digest, ))
+        points = [(c, u, k, zlib.decompress(w)) for c, u, k, w in cur]
+        cur.close()
+        return points or None
+
+    def save(self, digest, points):
+        q = """INSERT OR REPLACE INTO {} VALUES (?,?,?,?,?,?)""".format(
+            GzipIndex.TABLE_NAME)
+        cur = self.db.cursor()
+        cur.executemany(q, ((digest, i, c, u, k, zlib.compress(w))
+                            for i, (c, u, k, w) in enumerate(points)))
+        cur.close()
+        self.logger.info('Save %d access points of %s', len(points), digest)
+
+    @staticmethod
+    def build(path, span=GZIP_INDEX_SPAN):
+        '''Decompress the whole gzip file, and return access points of
+        (compressed offset, uncompressed offset, kind, window) tuples about
+        every `span` bytes of uncompressed data.
+        The window is the last 32KiB of uncompressed data before the point.
+        '''
+        builder = GzipIndexBuilder(span)
+        with open(path, 'rb') as fp:
+            for block in iter(partial(fp.read, GZIP_BLOCK_SIZE), b''):
+                for _ in builder.feed(block):
+                    pass
+        builder.close()
+        return builder.points
+
+    @staticmethod
+    def open(path, points, offset):
+        '''Open `GzipPipeReader` to decompress from the last access point
+        at or before the uncompressed `offset`. Its `tell()` starts at the
+        uncompressed offset of the point.
+        '''
+        compressed, uncompressed, kind, window = [
+            p for p in points if p[1] <= offset][-1]
+        return GzipPipeReader(path, start=compressed,
+                              window=window if kind == 'flush' else None,
+                              position=uncompressed)
+
+    @staticmethod
+    def _restartable(d, probe, window):
+        # Verify the flush marker by inflating the following data from it.
+        probe = probe[:4096]
+        try:
+            expected = d.copy().decompress(probe)
+            actual = zlib.decompressobj(-15, zdict=window).decompress(probe)
+        except zlib.error:
+            return False
+        return len(actual) > 0 and expected == actual
+
+    @staticmethod
+    def chunks(points, chunk_size):
+        # Group access points into ranges of about `chunk_size` bytes, and
+        # return tuples of the point and the limit to process from it.
+        selected = [points[0]]
+        for p in points[1:]:
+            if p[1] - selected[-1][1] >= chunk_size:
+                selected.append(p)
+        limits = [q[1] - p[1] for p, q in zip(selected, selected[1:])]
+        return list(zip(selected, limits + [None]))
+
+
+class GzipIndexBuilder(object):
+
+    '''Find the access points of `GzipIndex.build()` incrementally, while
+    the gzip file is decompressed to be processed. Pass the compressed
+    blocks in order to `feed()`, which generates the decompressed data, and
+    call `close()` at the end. Points found so far are in `points`, each of
+    which is valid without the rest, e.g. to resume from a checkpoint.
+    '''
+
+    def __init__(self, span=GZIP_INDEX_SPAN):
+        self.span = span
+        self.points = []
+        self.window = b''
+        self.uncompressed = 0
+        self.d = None
+        # Compressed offset of the block fed next.
+        self.base = 0
+
+    def _due(self):
+        return (not self.points or
+                self.uncompressed - self.points[-1][1] >= self.span)
+
+    def feed(self, block):
+        '''Decompress the next `block`, and generate the output.'''
+        size = GzipIndex.WINDOW_SIZE
+        pos = 0
+        while pos < len(block):
+            d = self.d
+            if d is None or d.eof:
+                # Skip zero padding as `gzip` does.
+                while pos < len(block) and block[pos] == 0:
+                    pos += 1
+                if pos == len(block):
+                    break
+                if self._due():
+                    self.points.append((self.base + pos, self.uncompressed,
+                                        'member', self.window))
+                self.d = zlib.decompressobj(31)
+                continue
+            # Inflate up to the next flush marker to check there.
+            end = len(block)
+            i = block.find(GzipIndex.FLUSH_MARKER, pos)
+            if i >= 0:
+                end = i + len(GzipIndex.FLUSH_MARKER)
+            data = block[pos:end]
+            while not d.eof:
+                out = d.decompress(data, GZIP_BLOCK_SIZE * 4)
+                self.uncompressed += len(out)
+                self.window = (self.window + out[-size:])[-size:]
+                if out:
+                    yield out
+                data = d.unconsumed_tail
+                if not data and len(out) < GZIP_BLOCK_SIZE * 4:
+                    break
+            pos = end - len(d.unused_data) if d.eof else end
+            if (self._due() and not d.eof and end < len(block) and
+                    GzipIndex._restartable(d, block[end:], self.window)):
+                self.points.append((self.base + end, self.uncompressed,
+                                    'flush', self.window))
+        self.base += len(block)
+
+    def close(self):
+        '''Raise EOFError if the gzip file is truncated.'''
+        if self.d is None or not self.d.eof:
+            raise EOFError('Compressed file ended before the '
+                           'end-of-stream marker was reached')
+
+
+class Ingester(object):
+
+    '''Load rows of CSV input files into a table of the local database.
+
+    Rows are inserted by `executemany()` every `batch_size` rows in one
+    transaction per file, which is committed with its monitor record by
+    `MainProcess`. Columns are named by the header line, or "c1", "c2", ...
+    without header, and added to the table if a later file has more.
+    They are declared without type not to convert values, e.g. to keep
+    leading zeros of zip codes.
+    Call `start()` before loading and `finish()` after that, which tunes
+    PRAGMAs of the connection for bulk load, and creates the indexes of
+    "col1,col2" strings only after the load.
+    '''
+
+    def __init__(self, db, table, indexes=(), batch_size=INGEST_BATCH_SIZE,
+                 cache_size=INGEST_CACHE_SIZE):
+        self.logger = logging.getLogger(APPNAME + '.ingest')
+        self.db = db
+        self.table = table
+        self.indexes = indexes
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.columns = None
+        self.pragmas = None
+
+    @staticmethod
+    def quote(name):
+        return '"{}"'.format(name.replace('"', '""'))
+
+    def start(self):
+        # Remember PRAGMAs to restore, and relax them for bulk load.
+        cur = self.db.cursor()
+        self.pragmas = {}
+        for k in ('synchronous', 'cache_size'):
+            self.pragmas[k] = cur.execute('PRAGMA {}'.format(k)).fetchone()[0]
+        # Loaded rows are recovered by loading the file again on a crash.
+        cur.execute('PRAGMA synchronous = OFF')
+        cur.execute('PRAGMA cache_size = {:d}'.format(-self.cache_size))
+        cur.close()
+
+    def finish(self):
+        cur = self.db.cursor()
+        if self.columns is not None:
+            for index in self.indexes:
+                names = [c.strip() for c in index.split(',')]
+                unknown = [c for c in names if c not in self.columns]
+                if unknown:
+                    self.logger.warning('Unknown index columns: %s',
+                                        ', '.join(unknown))
+                    continue
+                ddl = 'CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                    self.quote('{}_{}'.format(self.table, '_'.join(names))),
+                    self.quote(self.table),
+                    ','.join(self.quote(c) for c in names))
+                self.logger.info('Create index: %s', ddl)
+                cur.execute(ddl)
+        for k, v in sorted((self.pragmas or {}).items()):
+            cur.execute('PRAGMA {} = {}'.format(k, v))
+        cur.close()
+        self.pragmas = None
+
+    def prepare(self, names):
+        # Create the table, or add the columns which are not in it yet.
+        cur = self.db.cursor()
+        if self.columns is None:
+            cur.execute('PRAGMA table_info({})'.format(self.quote(self.table)))
+            self.columns = [r[1] for r in cur]
+            if not self.columns:
+                ddl = 'CREATE TABLE {} ({})'.format(
+                    self.quote(self.table),
+                    ','.join(self.quote(k) for k in names))
+                self.logger.info('Create ingest table: %s', ddl)
+                cur.execute(ddl)
+                self.columns = list(names)
+        for k in names:
+            if k not in self.columns:
+                ddl = 'ALTER TABLE {} ADD COLUMN {}'.format(
+                    self.quote(self.table), self.quote(k))
+                self.logger.info('Add ingest column: %s', ddl)
+                cur.execute(ddl)
+                self.columns.append(k)
+        cur.close()
+
+    def load(self, fp, header):
+        '''Insert the rows of CSV text file `fp`, and return the numbers of
+        lines and rows.
+        '''
+        import csv
+        reader = csv.reader(fp)
+        first = next(reader, None)
+        if first is None:
+            return {'lines': 0, 'rows': 0}
+        if header:
+            names = [k or 'c{}'.format(i + 1) for i, k in enumerate(first)]
+            rows = reader
+        else:
+            names = ['c{}'.format(i + 1) for i in range(len(first))]
+            rows = chain([first], reader)
+        self.prepare(names)
+        n = len(names)
+        q = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            self.quote(self.table), ','.join(self.quote(k) for k in names),
+            ','.join('?' * n))
+        cur = self.db.cursor()
+        count = 0
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if not batch:
+                break
+            # Pad or cut the rows not to fail on a ragged line.
+            cur.executemany(q, (r if len(r) == n else (r + [None] * n)[:n]
+                                for r in batch))
+            count += len(batch)
+        cur.close()
+        return {'lines': reader.line_num, 'rows': count}
+
+
+class Tabular(object):
+
+    '''JSON Table Schema based record class.
+
+    FIELDS = (
+        {'name': 'id', 'type': 'string'},
         {'name': 'updated', 'type': 'datetime', 'format': '%Y-%m-%dT%H:%M:%SZ'},
         {'name': 'name', 'type': 'string'},
         {'name': 'latitude', 'type': 'float'},
@@ -464,37 +2259,177 @@ class Tabular(object):
 
     def __init__(self, fields):
         self.fields = fields
+        # Compile the schema into converters not to look up it every row.
+        self.converters = [self.compile(f) for f in fields]
 
     def header(self):
         return [f['name'] for f in self.fields]
 
-    def __call__(self, dt):
-        out = []
-        for f in self.fields:
-            k, t = f['name'], f['type']
-            v = dt.get(k, f.get('default', ''))
-            if v is None:
-                val = ''
-            elif t == 'string':
-                val = v
-            elif t == 'datetime':
-                val = v.strftime(f['format'])
-            elif t == 'integer':
-                val = str(v)
-            elif t in ('float', 'numeric'):
-                if 'precision' in f:
-                    v = round(v, f['precision'])
-                val = str(v)
-            elif t == 'boolean':
-                m = f.get('mapping', {})
-                if v in m:
-                    val = m[v]
-                else:
-                    val = str(v)
+    @staticmethod
+    def compile(f):
+        k, t = f['name'], f['type']
+        default = f.get('default', '')
+        if t == 'string':
+            def convert(v):
+                return v
+        elif t == 'datetime':
+            fmt = f['format']
+
+            def convert(v):
+                return v.strftime(fmt)
+        elif t == 'integer':
+            convert = str
+        elif t in ('float', 'numeric'):
+            if 'precision' in f:
+                precision = f['precision']
+
+                def convert(v):
+                    return str(round(v, precision))
             else:
-                raise ValueError('Unknown type "{}" for "{}"'.format(t, k))
-            out.append(val)
-        return out
+                convert = str
+        elif t == 'boolean':
+            m = f.get('mapping', {})
+
+            def convert(v):
+                if v in m:
+                    return m[v]
+                return str(v)
+        else:
+            raise ValueError('Unknown type "{}" for "{}"'.format(t, k))
+
+        def encode(dt):
+            v = dt.get(k, default)
+            if v is None:
+                return ''
+            return convert(v)
+        return encode
+
+    def __call__(self, dt):
+        return [c(dt) for c in self.converters]
+
+    def encode_many(self, rows):
+        converters = self.converters
+        for dt in rows:
+            yield [c(dt) for c in converters]
+
+
+class TabularReader(object):
+
+    '''Read CSV rows into column batches by JSON Table Schema fields, the
+    inverse of `Tabular`.
+
+    Each batch is a dict of field name to the column of up to `batch_size`
+    values. Integer, float and boolean columns are `array.array`, or
+    `numpy.ndarray` if NumPy is available and `use_numpy` is not False.
+    The others are lists of str or `datetime.datetime`.
+    Empty value is parsed as `default` of the field if any. Otherwise it is
+    None for string and datetime, NaN for float, and an error for integer
+    and boolean which have no missing value in arrays.
+    '''
+
+    # Array type codes of the numeric columns.
+    TYPECODES = {'integer': 'q', 'float': 'd', 'numeric': 'd', 'boolean': 'b'}
+
+    def __init__(self, fields, batch_size=TABULAR_BATCH_SIZE, use_numpy=None):
+        self.fields = fields
+        self.batch_size = batch_size
+        self.numpy = None
+        if use_numpy is not False:
+            try:
+                import numpy
+                self.numpy = numpy
+            except ImportError:
+                if use_numpy:
+                    raise
+        self.parsers = [self.compile(f) for f in fields]
+
+    @staticmethod
+    def compile(f):
+        k, t = f['name'], f['type']
+        if t == 'string':
+            def parse(v):
+                return v
+        elif t == 'datetime':
+            import datetime
+            fmt = f['format']
+
+            def parse(v):
+                return datetime.datetime.strptime(v, fmt)
+        elif t == 'integer':
+            parse = int
+        elif t in ('float', 'numeric'):
+            parse = float
+        elif t == 'boolean':
+            # Values encoded by `Tabular` with the same mapping.
+            m = {'True': True, 'False': False}
+            m.update((v, b) for b, v in f.get('mapping', {}).items())
+
+            def parse(v):
+                return m[v]
+        else:
+            raise ValueError('Unknown type "{}" for "{}"'.format(t, k))
+        if 'default' in f:
+            missing = f['default']
+        elif t in ('float', 'numeric'):
+            missing = float('nan')
+        else:
+            missing = None
+        required = missing is None and t in ('integer', 'boolean')
+
+        def decode(v):
+            if v == '':
+                if required:
+                    raise ValueError('Missing value for "{}"'.format(k))
+                return missing
+            try:
+                return parse(v)
+            except (ValueError, KeyError):
+                raise ValueError('Invalid {} "{}" for "{}"'.format(t, v, k))
+        return decode
+
+    def read(self, fp, header=True):
+        '''Generate column batches of CSV text file `fp`.
+        If `header`, columns are looked up by the names of the header line,
+        otherwise they are in the order of the fields.
+        '''
+        import csv
+        reader = csv.reader(fp)
+        names = [f['name'] for f in self.fields]
+        if header:
+            line = next(reader, None)
+            if line is None:
+                return
+            missing = set(names) - set(line)
+            if missing:
+                raise ValueError('Missing columns: {}'.format(
+                    ', '.join(sorted(missing))))
+            indexes = [line.index(k) for k in names]
+        else:
+            indexes = range(len(names))
+        while True:
+            rows = list(islice(reader, self.batch_size))
+            if not rows:
+                break
+            yield self.columns(rows, indexes)
+
+    def columns(self, rows, indexes=None):
+        '''Convert `rows` of str lists into a batch of columns.'''
+        import array
+        if indexes is None:
+            indexes = range(len(self.fields))
+        batch = {}
+        for f, parse, i in zip(self.fields, self.parsers, indexes):
+            values = [parse(r[i]) for r in rows]
+            typecode = self.TYPECODES.get(f['type'])
+            if typecode:
+                values = array.array(typecode, values)
+                if self.numpy is not None:
+                    # Share the buffer without copying.
+                    values = self.numpy.frombuffer(values, values.typecode)
+                    if typecode == 'b':
+                        values = values.view(bool)
+            batch[f['name']] = values
+        return batch
 
 # Default monitor dump schema. If you add more fields to dump, add it here.
 MONITOR_DUMP_FIELDS = (
@@ -509,20 +2444,82 @@ MONITOR_DUMP_FIELDS = (
     {'name': 'finish_at', 'type': 'datetime', 'format': DATETIME_FORMAT},
     {'name': 'elapsed', 'type': 'float', 'precision': 4},
     {'name': 'digest', 'type': 'string'},
+    {'name': 'digest_type', 'type': 'string'},
+    {'name': 'hash_time', 'type': 'float', 'precision': 4},
+    {'name': 'open_time', 'type': 'float', 'precision': 4},
+    {'name': 'process_time', 'type': 'float', 'precision': 4},
+    {'name': 'bytes_read', 'type': 'integer'},
+    {'name': 'throughput', 'type': 'float', 'precision': 1},
 )
 
 
+class Reducer(object):
+
+    """Merge results of `App.process()` into a run-wide aggregate.
+    `combine()` must be associative with `initial()` as its identity, so
+    that results of chunks, files and workers are merged in any grouping.
+    The default sums up the numbers of the same keys, and keeps the first
+    value of the others, e.g. strings.
+    """
+
+    def initial(self):
+        return {}
+
+    @staticmethod
+    def numeric(v):
+        return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+    def combine(self, acc, result):
+        '''Merge `result` into the accumulator `acc` and return it.'''
+        for k, v in result.items():
+            if k not in acc:
+                acc[k] = v
+            elif self.numeric(acc[k]) and self.numeric(v):
+                acc[k] += v
+        return acc
+
+    def finalize(self, acc):
+        '''Convert the accumulator into the aggregate to report.'''
+        return acc
+
+    def reduce(self, results):
+        '''Combine `results` except None, return None if nothing is left.'''
+        acc = None
+        for r in results:
+            if r is not None:
+                acc = self.combine(self.initial() if acc is None else acc, r)
+        return acc
+
+
 class App(object):
 
     """Main application class.
     # TODO: Implement your logic.
     """
 
+    # Set False to count lines by `scan()` on binary blocks without decoding,
+    # only if `process()` is left as it is; `scan()` bypasses it.
+    needs_text = True
+
+    # Merge the results of chunks and files, see `Reducer`.
+    reducer = Reducer()
+
     def __init__(self, db):
         self.logger = logging.getLogger(APPNAME + '.app')
         self.db = db
+        # Output file to write, see `OutputWriter`.
+        self.output = None
+        # Callback of (offset, lines, result) to save the progress every
+        # `checkpoint_every` bytes, see `ProgressMonitor.checkpoint()`.
+        self.checkpoint = None
+        self.checkpoint_every = 0
+        self.checkpointed = 0
+        # Load the rows into the local database instead, see `Ingester`.
+        self.ingester = None
 
     def process(self, fp, header):
+        if self.ingester:
+            return self.ingester.load(fp, header)
         lines = 0
         if header:  # skip header line
             next(fp)
@@ -533,6 +2530,216 @@ class App(object):
             lines += 1
         return {'lines': lines}
 
+    def scan(self, fp, header, resume=None):
+        '''Fast path of `process()` to count lines on binary blocks of `fp`.
+        Header line is counted as `process()` does. "\\n", "\\r\\n" and
+        "\\r" are line separators as in text mode.
+        If `resume` of (offset, lines, result) is given, continue from the
+        checkpoint.
+        '''
+        offset, lines = resume[:2] if resume else (0, 0)
+        self.checkpointed = offset
+        last = b'\n'
+        if offset:
+            # The byte before the checkpoint tells whether it is in the middle
+            # of a line, which is counted at the end.
+            skip_bytes(fp, offset - 1)
+            last = fp.read(1)
+        buf = bytearray(SCAN_BLOCK_SIZE)
+        for n in iter(partial(fp.readinto, buf), 0):
+            lines += (buf.count(b'\n', 0, n) + buf.count(b'\r', 0, n) -
+                      buf.count(b'\r\n', 0, n))
+            # "\r\n" split by the blocks.
+            if last == b'\r' and buf[0] == 0x0a:
+                lines -= 1
+            last = buf[n - 1:n]
+            offset += n
+            self.save(offset, lines)
+        # The last line without line separator.
+        if last not in (b'\n', b'\r'):
+            lines += 1
+        return {'lines': lines}
+
+    def save(self, offset, lines, result=None):
+        # Report the progress to `checkpoint` if enough bytes are read.
+        if (self.checkpoint and
+                offset - self.checkpointed >= self.checkpoint_every):
+            self.checkpoint(offset, lines, result or {'lines': lines})
+            self.checkpointed = offset
+
+    def merge(self, results):
+        '''Merge results of the chunks of a file into one.'''
+        return self.reducer.reduce(results)
+
+
+# Application instance of each worker process, see `MainProcess.run()`.
+_worker_app = None
+
+
+def _init_worker():
+    global _worker_app
+    # Threads of the parent handling log records are not forked.
+    stop_logging(wait=False)
+    # Worker process cannot share the local SQLite3 connection.
+    _worker_app = App(None)
+
+
+def _process_in_worker(path, encoding, header, algorithm, pipeline,
+                       index_span=0):
+    # Access points found on the same pass, if `index_span` is given, are
+    # returned in the stats for the parent to save.
+    builder = GzipIndexBuilder(index_span) if index_span else None
+    r, digest, stats = process_path(_worker_app, path, encoding, header,
+                                    algorithm, pipeline, builder=builder)
+    if builder:
+        stats['gzip_points'] = builder.points
+    return r, digest, stats
+
+
+def _process_chunk_in_worker(path, encoding, header, start, end):
+    return process_range(_worker_app, path, encoding, header, start, end)
+
+
+def _process_gzip_chunk_in_worker(path, encoding, header, point, limit):
+    return process_gzip_range(_worker_app, path, encoding, header, point,
+                              limit)
+
+
+class MetricsReporter(object):
+
+    '''Write live metrics of the run to `path` every `interval` seconds on
+    a background thread, in Prometheus text format if the path ends with
+    ".prom", otherwise in JSON.
+    The file is replaced atomically, so that a monitoring agent never reads
+    a partial file. `MainProcess` passes the counter of each run to
+    `begin()`, and adds the bytes read in `finish()`; the thread only reads
+    them.
+    '''
+
+    CATEGORIES = ('process', 'skip', 'ignore')
+
+    def __init__(self, path, interval=DEFAULT_METRICS_INTERVAL):
+        self.logger = logging.getLogger(APPNAME + '.metrics')
+        self.path = path
+        self.interval = interval
+        # Counters of the previous runs, and of the current run.
+        self.base = Counter()
+        self.counter = Counter()
+        self.expected = None
+        self.bytes_read = 0
+        self.run_bytes_read = 0
+        self.started_at = self.run_started_at = time.time()
+        self.finished_at = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._report, daemon=True)
+        self.thread.start()
+
+    def begin(self, counter, expected=None):
+        '''Start reporting `counter` of a run of `expected` files if known.
+        '''
+        self.base.update(self.counter)
+        self.counter = counter
+        self.expected = expected
+        self.run_started_at = time.time()
+        self.run_bytes_read = 0
+
+    def finish(self, stats=None):
+        '''Count a file finished or skipped with its `stats` if any.'''
+        self.finished_at = time.time()
+        n = (stats or {}).get('bytes_read') or 0
+        self.bytes_read += n
+        self.run_bytes_read += n
+
+    def metrics(self):
+        '''Return the current metrics as a dict.'''
+        now = time.time()
+        counter = self.counter
+        files = dict((k, self.base[k] + counter.get(k, 0))
+                     for k in self.CATEGORIES)
+        m = {
+            'timestamp': now,
+            'elapsed_seconds': now - self.started_at,
+            'files': files,
+            'bytes_read': self.bytes_read,
+            'files_per_second': 0.0,
+            'bytes_per_second': 0.0,
+            'files_remaining': None,
+            'eta_seconds': None,
+            'last_file_age_seconds': None,
+        }
+        if self.finished_at is not None:
+            m['last_file_age_seconds'] = now - self.finished_at
+        if not counter and self.expected is None:
+            return m
+        # Rates of the current run.
+        done = sum(counter.get(k, 0) for k in self.CATEGORIES)
+        elapsed = now - self.run_started_at
+        if elapsed > 0:
+            m['files_per_second'] = done / elapsed
+            m['bytes_per_second'] = self.run_bytes_read / elapsed
+        if self.expected is not None:
+            m['files_remaining'] = max(self.expected - done, 0)
+            if m['files_per_second']:
+                m['eta_seconds'] = (m['files_remaining'] /
+                                    m['files_per_second'])
+        return m
+
+    def format_prometheus(self, m):
+        prefix = APPNAME.replace('-', '_')
+        lines = [
+            '# HELP {}_files_total Files by category.'.format(prefix),
+            '# TYPE {}_files_total counter'.format(prefix),
+        ]
+        for k in self.CATEGORIES:
+            lines.append('{}_files_total{{category="{}"}} {}'.format(
+                prefix, k, m['files'][k]))
+        gauges = (
+            ('bytes_read_total', 'counter', 'Bytes read from input files.'),
+            ('files_per_second', 'gauge', 'Files finished per second.'),
+            ('bytes_per_second', 'gauge', 'Bytes read per second.'),
+            ('files_remaining', 'gauge', 'Files left in the run.'),
+            ('eta_seconds', 'gauge', 'Estimated seconds to finish the run.'),
+            ('last_file_age_seconds', 'gauge',
+             'Seconds since the last file was finished.'),
+            ('elapsed_seconds', 'gauge', 'Seconds since started.'),
+        )
+        m = dict(m, bytes_read_total=m['bytes_read'])
+        for name, kind, text in gauges:
+            # Unknown values are left out, Prometheus has no null.
+            if m[name] is None:
+                continue
+            lines.append('# HELP {}_{} {}'.format(prefix, name, text))
+            lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+            lines.append('{}_{} {}'.format(prefix, name, m[name]))
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        m = self.metrics()
+        if self.path.endswith('.prom'):
+            text = self.format_prometheus(m)
+        else:
+            import json
+            text = json.dumps(m, sort_keys=True) + '\n'
+        # Replace the file at once not to be read while writing.
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w', encoding='utf8') as fp:
+            fp.write(text)
+        os.replace(tmp, self.path)
+
+    def _report(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                self.logger.warning('Failed to write metrics: %s', e)
+
+    def close(self):
+        '''Stop the thread, and write the final metrics.'''
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+        self.logger.info('Write metrics: %s', self.path)
+
 
 class MainProcess(object):
 
@@ -542,6 +2749,8 @@ class MainProcess(object):
     def __init__(self, dryrun):
         self.dryrun = dryrun
         self.logger = logging.getLogger(APPNAME + '.main')
+        # Set to stop `watch()`.
+        self.stopped = threading.Event()
 
     def configure(self, configfile):
         if not os.path.isfile(configfile):
@@ -557,57 +2766,394 @@ class MainProcess(object):
         # TODO: Implement your logic.
 
     def initialize(self, config, output, output_encoding,
-                   sqlite=None, monitor_dump=None):
+                   sqlite=None, monitor_dump=None, monitor_since=None,
+                   single_pass=False,
+                   verify_digest=False, algorithm=DEFAULT_HASH_ALGORITHM,
+                   commit_every=DEFAULT_COMMIT_EVERY,
+                   commit_interval=DEFAULT_COMMIT_INTERVAL,
+                   journal_mode=DEFAULT_JOURNAL_MODE, fingerprint_size=0,
+                   upgrade_digest=False, shard=None, ingest=None,
+                   ingest_indexes=(), output_buffer=OUTPUT_BUFFER_SIZE,
+                   output_partition=None, metrics=None,
+                   metrics_interval=DEFAULT_METRICS_INTERVAL):
+        self.single_pass = single_pass
+        self.monitor_since = monitor_since
+        self.shard = shard
+        # Positions of the files in a shard among all the inputs.
+        self.position = 0
+        self.order = []
+        self.summary = Counter()
+        # Aggregate of the results processed so far, see `Reducer`.
+        self.reducer = App.reducer
+        self.aggregate = self.reducer.initial()
         if config:
             self.configure(config)
         if output:
-            if os.path.isfile(output):
+            if os.path.isfile(output) and not output_partition:
                 self.logger.warn('Overwrite output file: %s', output)
-            self.output = open(output, 'w', encoding=output_encoding)
+            self.output = OutputWriter(output, output_encoding,
+                                       output_buffer,
+                                       partition=output_partition)
         else:
             self.output = sys.stdout
+        self.partition_inputs = bool(output) and output_partition == 'input'
         if sqlite and os.path.isfile(sqlite):
             self.logger.info('Reuse local SQLite3 file: %s', sqlite)
+        import sqlite3
         self.localdb = sqlite3.connect(sqlite or DEFAULT_SQLITE_FILE)
-        self.monitor = ProgressMonitor(self.localdb, monitor_dump)
+        self.monitor = ProgressMonitor(self.localdb, monitor_dump,
+                                       verify_digest, algorithm,
+                                       commit_every, commit_interval,
+                                       journal_mode, fingerprint_size,
+                                       upgrade_digest)
+        if isinstance(self.output, OutputWriter):
+            # Not to commit the records of the inputs whose output is lost.
+            self.monitor.before_commit = self.output.sync
+        self.ingester = None
+        if ingest:
+            self.ingester = Ingester(self.localdb, ingest, ingest_indexes)
+        self.metrics = None
+        if metrics:
+            self.metrics = MetricsReporter(metrics, metrics_interval)
 
     def terminate(self):
-        self.monitor.terminate(MONITOR_DUMP_FIELDS)
+        # Write all the output before committing the records of the inputs.
         if not self.output.isatty():
             self.output.close()
+        self.monitor.upgrade(wait=True)
+        if self.summary:
+            self.monitor.save_summary(self.summary)
+        if self.order:
+            self.monitor.save_order(self.order)
+        self.monitor.commit()
+        self.monitor.terminate(MONITOR_DUMP_FIELDS, self.monitor_since)
+        if self.metrics:
+            self.metrics.close()
         self.localdb.commit()
         self.logger.info('Terminated the process.')
 
-    def run(self, files, encoding, header):
+    def run(self, files, encoding, header, jobs=1, hash_jobs=1, chunk_size=0,
+            pipeline=False, gzip_index=False, checkpoint=0):
         app = App(self.localdb)
+        app.output = self.output
+        if self.partition_inputs:
+            # Only the serial run writes the output of each input.
+            jobs = 1
+        if self.ingester:
+            # Worker processes cannot write to the local database.
+            app.ingester = self.ingester
+            app.needs_text = True
+            jobs = 1
+            # PRAGMAs cannot be changed in a transaction.
+            self.monitor.commit()
+            self.ingester.start()
+        if checkpoint:
+            self._set_checkpoint(app, encoding, jobs, checkpoint)
+        self.gzip_index = GzipIndex(self.localdb) if gzip_index else None
+        # Builder of the gzip index of the file processed serially.
+        self.builder = None
         if not files:
             app.process(sys.stdin, header)
+            self._finish_ingest()
             return
+        if self.shard:
+            selected = self._select_shard(files)
+            # Keep the list to know the number of files.
+            files = list(selected) if isinstance(files, list) else selected
         counter = Counter()
-        for path in files:
-            counter['total'] += 1
-            canskip = self.monitor.start(path)
-            if canskip:
-                counter['skip'] += 1
-                self.logger.info('Skip to process: %s', path)
+        if self.metrics:
+            # Number of files is unknown on streaming.
+            self.metrics.begin(counter, len(files)
+                               if isinstance(files, list) else None)
+        self.reducer = app.reducer
+        aggregate = self.aggregate
+        self.aggregate = self.reducer.initial()
+        if hash_jobs > 1 and not self.single_pass:
+            # Calculate hash values ahead, except for unchanged files and
+            # files to take fingerprints.
+            files = hash_files(files, self.monitor.algorithm, hash_jobs,
+                               self._prehash)
+        else:
+            files = ((f, None, None) for f in files)
+        if jobs > 1:
+            self._run_parallel(app, files, encoding, header, jobs, chunk_size,
+                               pipeline, counter)
+        else:
+            for f, digest, hash_time in files:
+                path, st = file_stat(f)
+                if self._start(path, st, digest, hash_time, counter):
+                    continue
+                if self.partition_inputs:
+                    self.output.next_input()
+                builder, points = self._gzip_index(path)
+                self.builder = builder
+                r, digest, stats = process_path(app, path, encoding, header,
+                                                self._algorithm(), pipeline,
+                                                self.monitor.resume, builder,
+                                                points)
+                if builder:
+                    stats['gzip_points'] = builder.points
+                self._finish(path, r, digest, stats, counter)
+                if self.ingester:
+                    # Commit the rows with the record of the file.
+                    self.monitor.commit()
+        self._finish_ingest()
+        self.summary.update(counter)
+        self._show_summary(counter)
+        self._show_aggregate(self.aggregate)
+        self.aggregate = self.reducer.combine(aggregate, self.aggregate)
+        return counter
+
+    def _select_shard(self, files):
+        # Files in the shard, numbered in the order of all the inputs, which
+        # every shard sees the same.
+        for f in files:
+            path = f.path if isinstance(f, os.DirEntry) else f
+            self.position += 1
+            if in_shard(path, self.shard):
+                self.order.append((path, self.position))
+                yield f
+
+    def _show_summary(self, counter):
+        self.logger.info('show summary:')
+        for k in sorted(counter):
+            self.logger.info(' - {:20s} : {:,}'.format(k, counter[k]))
+
+    def _finish_ingest(self):
+        if self.ingester:
+            self.monitor.commit()
+            self.ingester.finish()
+
+    def _show_aggregate(self, aggregate):
+        self.logger.info('show aggregate: %s',
+                         self.reducer.finalize(aggregate))
+
+    def results(self):
+        '''Return the aggregate of all the results processed so far.'''
+        return self.reducer.finalize(self.aggregate)
+
+    def merge(self, paths):
+        '''Merge monitor records of the SQLite3 files run by `--shard` into
+        the local database, as if the files were processed on one host.
+        Records are added in the order of the inputs saved by the shards, or
+        in the walk order if not saved, and only the first record of the
+        same digest is kept. Return the summary counters.
+        '''
+        import json
+        import sqlite3
+        schema = [f['name'] for f in ProgressMonitor.SCHEMA['fields']]
+        counter = Counter()
+        records = {}
+        for path in paths:
+            self.logger.info('Merge monitor records: %s', path)
+            db = sqlite3.connect(path)
+            counter['total'] += ProgressMonitor.load_summary(db)['total']
+            order = ProgressMonitor.load_order(db)
+            cur = db.execute('SELECT * FROM {}'.format(
+                ProgressMonitor.TABLE_NAME))
+            names = [d[0] for d in cur.description]
+            for row in cur:
+                # Seq is numbered again on inserting.
+                t = dict((k, v) for k, v in zip(names, row)
+                         if k in schema and k != 'seq')
+                position = order.get(t['path'])
+                key = (position is None, position or 0, walk_key(t['path']))
+                other = records.get(t['digest'])
+                if other is None or key < other[0]:
+                    records[t['digest']] = (key, t)
+            db.close()
+        cur = self.localdb.cursor()
+        aggregate = self.reducer.initial()
+        for _, t in sorted(records.values(), key=lambda r: r[0]):
+            q = 'INSERT INTO {} ({}) VALUES ({})'.format(
+                ProgressMonitor.TABLE_NAME, ','.join(t),
+                ','.join('?' * len(t)))
+            try:
+                cur.execute(q, tuple(t.values()))
+            except sqlite3.IntegrityError:
+                self.logger.info('Already merged: %s', t['path'])
                 continue
-            _, suffix = os.path.splitext(path)
-            if suffix == '.gz':
-                opener = gzip.open
-                open_mode = 'rt'
-            else:
-                opener = open
-                open_mode = 'r'
-            with opener(path, open_mode, encoding=encoding) as fp:
-                r = app.process(fp, header)
-            self.monitor.finish(r)
-            if r is None:
+            if t['result'] is None:
                 counter['ignore'] += 1
             else:
                 counter['process'] += 1
-        self.logger.info('show summary:')
-        for k in sorted(counter):
-            self.logger.info(' - {:20s} : {:,}'.format(k, counter[k]))
+                aggregate = self.reducer.combine(aggregate,
+                                                 json.loads(t['result']))
+        cur.close()
+        # Files processed on the other shards, too, are skipped.
+        counter['skip'] = counter['total'] - counter['process'] - \
+            counter['ignore']
+        counter = +counter
+        self.summary.update(counter)
+        self._show_summary(counter)
+        self._show_aggregate(aggregate)
+        self.aggregate = self.reducer.combine(self.aggregate, aggregate)
+        return counter
+
+    def watch(self, watcher, interval, encoding, header, *args):
+        '''Process new files found by `watcher` every `interval` seconds
+        until stopped, keeping the local database open.
+        The rest of arguments are passed to `run()`.
+        '''
+        self.logger.info('Watch files every %s seconds.', interval)
+        try:
+            while not self.stopped.is_set():
+                files = watcher.poll()
+                if files:
+                    self.run(files, encoding, header, *args)
+                    # Make the records visible to the others at once.
+                    self.monitor.commit()
+                self.stopped.wait(interval)
+        except KeyboardInterrupt:
+            self.logger.info('Interrupted to watch files.')
+
+    def _run_parallel(self, app, files, encoding, header, jobs, chunk_size,
+                      pipeline, counter):
+        """Dispatch `App.process()` to worker processes.
+        Uncompressed file larger than `chunk_size` is split into byte ranges
+        to be processed in parallel, and their results are merged. So is gzip
+        file by the access points of `GzipIndex` if enabled.
+        Monitor records are written only in this process in the input order,
+        so that the same contents are recorded as the serial run does.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        pending = deque()
+        with ProcessPoolExecutor(jobs, initializer=_init_worker) as executor:
+            for f, digest, hash_time in files:
+                path, st = file_stat(f)
+                chunked = self._chunked(path, st, encoding, chunk_size)
+                # Chunks are processed separately, so hash the file ahead.
+                if self._start(path, st, digest, hash_time, counter,
+                               not chunked):
+                    continue
+                if chunked:
+                    futures = self._submit_chunks(executor, path, encoding,
+                                                  header, chunk_size, pipeline)
+                else:
+                    futures = [executor.submit(_process_in_worker, path,
+                                               encoding, header,
+                                               self._algorithm(), pipeline)]
+                pending.append((futures, path, self.monitor.detach()))
+                # Keep workers busy, but do not hash too far ahead of them.
+                self._drain(app, pending, counter, len(pending) >= jobs * 2)
+            while pending:
+                self._drain(app, pending, counter, True)
+
+    def _drain(self, app, pending, counter, block=False):
+        # Finish the tasks done in order, wait for the first one if `block`.
+        while pending and (block or all(f.done() for f in pending[0][0])):
+            futures, path, current = pending.popleft()
+            if len(futures) == 1:
+                r, digest, stats = futures[0].result()
+            else:
+                results = [f.result() for f in futures]
+                r = app.merge(t[0] for t in results)
+                digest = None
+                stats = merge_stats(t[2] for t in results)
+            self._finish(path, r, digest or current, stats, counter)
+            block = False
+
+    def _submit_chunks(self, executor, path, encoding, header, chunk_size,
+                       pipeline):
+        if not path.endswith('.gz'):
+            return [executor.submit(_process_chunk_in_worker, path, encoding,
+                                    header, start, end)
+                    for start, end in split_chunks(path, chunk_size)]
+        # Fan out only by the index stored on processing the file before,
+        # otherwise process it at once and build the index on the same pass.
+        points = self.gzip_index.load(self.monitor.current)
+        chunks = GzipIndex.chunks(points, chunk_size) if points else []
+        if len(chunks) <= 1:
+            span = 0 if points else GZIP_INDEX_SPAN
+            return [executor.submit(_process_in_worker, path, encoding, header,
+                                    None, pipeline, span)]
+        return [executor.submit(_process_gzip_chunk_in_worker, path, encoding,
+                                header, point, limit)
+                for point, limit in chunks]
+
+    def _set_checkpoint(self, app, encoding, jobs, checkpoint):
+        # Only `App.scan()` knows the byte offset of the lines it counted,
+        # and only the serial run knows the current record to save.
+        if app.needs_text or not ascii_compatible(encoding):
+            self.logger.warning('Checkpoint is ignored, App.process() '
+                                'reading text cannot resume.')
+        elif jobs > 1 or self.single_pass:
+            self.logger.warning('Checkpoint is ignored, except for the '
+                                'serial run without single pass.')
+        else:
+            app.checkpoint = self._checkpoint
+            app.checkpoint_every = checkpoint
+
+    def _gzip_index(self, path):
+        # Builder of the access points of the gzip file to process, or the
+        # points saved with the checkpoint to resume from.
+        if self.gzip_index is None or not path.endswith('.gz'):
+            return None, None
+        if self.monitor.resume:
+            return None, self.gzip_index.load(self.monitor.current)
+        return GzipIndexBuilder(), None
+
+    def _checkpoint(self, offset, lines, result=None):
+        # Save the points found so far, which are appended by the thread
+        # decompressing ahead, to resume from the nearest one.
+        points = list(self.builder.points) if self.builder else None
+        if points:
+            self.gzip_index.save(self.monitor.current, points)
+        self.monitor.checkpoint(offset, lines, result)
+
+    def _chunked(self, path, st, encoding, chunk_size):
+        # Whether to split the file to process in parallel.
+        if not chunk_size:
+            return False
+        if path.endswith('.gz') and self.gzip_index is None:
+            return False
+        if not ascii_compatible(encoding):
+            return False
+        return (st or os.stat(path)).st_size > chunk_size
+
+    def _prehash(self, f):
+        path, st = file_stat(f)
+        return not (self.monitor.unchanged(path, st) or
+                    self.monitor.sampled(path, st))
+
+    def _algorithm(self):
+        # Hash algorithm to calculate on processing, if any.
+        return self.monitor.algorithm if self.single_pass else None
+
+    def _start(self, path, st, digest, hash_time, counter, deferrable=True):
+        counter['total'] += 1
+        if self.single_pass and deferrable:
+            canskip = self.monitor.defer(path, st)
+        else:
+            canskip = self.monitor.start(path, digest, st, hash_time)
+        if canskip:
+            counter['skip'] += 1
+            self.logger.info('Skip to process: %s', path)
+            if self.metrics:
+                self.metrics.finish()
+        return canskip
+
+    def _finish(self, path, result, digest, stats, counter):
+        if isinstance(self.output, OutputWriter):
+            # Not to record the input if its output is not written.
+            self.output.check()
+        points = stats.pop('gzip_points', None) if stats else None
+        if points:
+            self.gzip_index.save(digest or self.monitor.current, points)
+        if self.metrics:
+            self.metrics.finish(stats)
+        if path in self.monitor.deferred:
+            if not self.monitor.settle(path, digest, result, stats):
+                counter['skip'] += 1
+                self.logger.info('Skip to record: %s', path)
+                return
+        else:
+            self.monitor.finish(result, digest, stats)
+        if result is None:
+            counter['ignore'] += 1
+        else:
+            counter['process'] += 1
+            self.aggregate = self.reducer.combine(self.aggregate, result)
 
 
 CONFIGURATION = """Start running with following configurations.
@@ -622,8 +3168,24 @@ CONFIGURATION = """Start running with following configurations.
   Input has header   : {header}
   Input #files       : {nfiles}
   Search recursive   : {recursive}
+  Shard              : {shard}
+  Watch interval     : {watch} sec
+  Parallel jobs      : {jobs}
+  Chunk size         : {chunk_size} MB
+  Gzip pipeline      : {pipeline}
+  Gzip index         : {gzip_index}
+  Checkpoint         : {checkpoint} MB
+  Ingest table       : {ingest} (index: {ingest_indexes})
+  Single pass        : {single_pass}
+  Verify digest      : {verify_digest}
+  Digest algorithm   : {algorithm} ({hash_jobs} threads)
+  Fingerprint        : > {fingerprint} MB (upgrade: {upgrade_digest})
+  Group commit       : {commit_every} files / {commit_interval} sec
   Output path        : {output}
+  Output buffer      : {output_buffer} KB (partition: {output_partition})
   Output encoding    : {encoding_out}
+  Metrics file       : {metrics} (every {metrics_interval} sec)
+  Profile stats file : {profile}
 ==============================================================================
 """.rstrip()
 
@@ -631,40 +3193,116 @@ CONFIGURATION = """Start running with following configurations.
 def main():
     # Parse command line arguments.
     args = parse_arguments()
-    files = collect_files(args.files, args.recursive)
+    if args.merge:
+        check_inputs(args.files)
+        files = args.files
+        nfiles = '{} (merging)'.format(len(files))
+    elif args.watch:
+        check_inputs(args.files, args.recursive)
+        files = DirectoryWatcher(args.files, args.recursive, args.watch)
+        nfiles = 'unknown (watching)'
+    elif args.stream:
+        files = iter_files(args.files, args.recursive)
+        nfiles = 'unknown (streaming)' if files else 0
+    else:
+        files = collect_files(args.files, args.recursive)
+        nfiles = len(files)
     encoding = args.encoding
     configfile = os.path.abspath(args.config) if args.config else None
     logger = logging.getLogger(APPNAME + '.setup')
     logger.info(CONFIGURATION.format(basedir=BASEDIR, cwd=os.getcwd(),
                 configfile=configfile, dryrun=args.dryrun,
-                encoding=encoding, nfiles=len(files or []),
-                recursive=args.recursive, header=args.header,
+                encoding=encoding, nfiles=nfiles,
+                recursive=args.recursive, watch=args.watch, jobs=args.jobs,
+                shard='{}/{}'.format(*args.shard) if args.shard else None,
+                chunk_size=args.chunk_size, pipeline=args.pipeline,
+                gzip_index=args.gzip_index, checkpoint=args.checkpoint,
+                ingest=args.ingest,
+                ingest_indexes=' / '.join(args.ingest_indexes) or None,
+                single_pass=args.single_pass,
+                verify_digest=args.verify_digest, algorithm=args.algorithm,
+                hash_jobs=args.hash_jobs, fingerprint=args.fingerprint,
+                upgrade_digest=args.upgrade_digest,
+                commit_every=args.commit_every,
+                commit_interval=args.commit_interval, header=args.header,
                 sqlite=args.sqlite, monitordumpfile=args.monitor_out,
-                output=args.output, encoding_out=args.encoding_out))
+                output=args.output, encoding_out=args.encoding_out,
+                output_buffer=args.output_buffer,
+                output_partition=args.output_partition,
+                metrics=args.metrics,
+                metrics_interval=args.metrics_interval,
+                profile=args.profile))
     # Initialize main class.
     processor = MainProcess(args.dryrun)
     processor.initialize(configfile, args.output, args.encoding_out,
-                         args.sqlite, args.monitor_out)
+                         args.sqlite, args.monitor_out,
+                         monitor_since=args.monitor_since,
+                         single_pass=args.single_pass,
+                         verify_digest=args.verify_digest,
+                         algorithm=args.algorithm,
+                         commit_every=args.commit_every,
+                         commit_interval=args.commit_interval,
+                         journal_mode=args.journal_mode,
+                         fingerprint_size=args.fingerprint * 1024 * 1024,
+                         upgrade_digest=args.upgrade_digest,
+                         shard=args.shard, ingest=args.ingest,
+                         ingest_indexes=args.ingest_indexes,
+                         output_buffer=args.output_buffer * 1024,
+                         output_partition=args.output_partition,
+                         metrics=args.metrics,
+                         metrics_interval=args.metrics_interval)
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    run_args = (encoding, args.header, args.jobs, args.hash_jobs,
+                args.chunk_size * 1024 * 1024, args.pipeline, args.gzip_index,
+                args.checkpoint * 1024 * 1024)
     # Dispatch main process, and catch unknown error.
     try:
-        processor.run(files, encoding, args.header)
+        if args.merge:
+            processor.merge(files)
+        elif args.watch:
+            import signal
+            signal.signal(signal.SIGTERM,
+                          lambda signum, frame: processor.stopped.set())
+            processor.watch(files, args.watch, *run_args)
+        else:
+            processor.run(files, *run_args)
     except Exception:
         e = sys.exc_info()[1]
         logger.error(e)
         traceback.print_exc(file=sys.stderr)
     finally:
         processor.terminate()
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logger.info('Write profile stats: %s', args.profile)
 
 
 if __name__ == '__main__':
-    main()
+    # Exit here not to define the test suites below.
+    sys.exit(main())
 
 
 # Test suites to bundle as one file script.
 # To run the tests, invoke this script using "-m unittest" option.
 # i.e. `python3 -m unittest -v boilerplate.py`
+import array
+import csv
+import datetime
+import gzip
+import hashlib
+import json
+import math
+import shutil
+import sqlite3
+import subprocess
 import tempfile
 import unittest
+from unittest import mock
 
 
 class TabularTest(unittest.TestCase):
@@ -702,6 +3340,74 @@ class TabularTest(unittest.TestCase):
                     '12.34', '-123.45678', 'ABCDEF', 'UNKNOWN', '0']
         self.assertEqual(expected, self.tabular(data))
 
+    def test_encode_many(self):
+        rows = [
+            {'id': '1', 'updated': None, 'latitude': 1.5, 'kind': None},
+            {'id': '2', 'updated': datetime.datetime(2000, 1, 1),
+             'longitude': -0.25, 'update_type': 3},
+        ]
+        expected = [self.tabular(r) for r in rows]
+        self.assertEqual(expected, list(self.tabular.encode_many(rows)))
+
+    def test_reader(self):
+        rows = [
+            {'id': '1', 'updated': datetime.datetime(2000, 1, 1, 12),
+             'latitude': 1.5, 'kind': None, 'update_type': 1},
+            {'id': '2', 'updated': None, 'name': 'x,"y"',
+             'longitude': -0.25, 'update_type': 3},
+            {'id': '3', 'updated': None, 'kind': 'K', 'update_type': 0},
+        ]
+        fp = io.StringIO()
+        writer = csv.writer(fp)
+        # Columns in the other order than the fields.
+        header = self.tabular.header()[::-1]
+        writer.writerow(header)
+        writer.writerows(r[::-1] for r in self.tabular.encode_many(rows))
+        fp.seek(0)
+        reader = TabularReader(self.tabular.fields, 2, use_numpy=False)
+        batches = list(reader.read(fp))
+        self.assertEqual(2, len(batches))
+        self.assertEqual(['1', '2'], batches[0]['id'])
+        self.assertEqual([datetime.datetime(2000, 1, 1, 12), None],
+                         batches[0]['updated'])
+        self.assertEqual([None, 'x,"y"'], batches[0]['name'])
+        self.assertEqual(array.array('d', [1.5]), batches[0]['latitude'][:1])
+        self.assertTrue(math.isnan(batches[0]['latitude'][1]))
+        self.assertEqual(['UNKNOWN', 'UNKNOWN'], batches[0]['kind'])
+        self.assertEqual(array.array('q', [1, 3]), batches[0]['update_type'])
+        self.assertEqual(['K'], batches[1]['kind'])
+        # Without header, columns are in the order of the fields.
+        fp = io.StringIO('1,,,,,,,x\n')
+        with self.assertRaises(ValueError):
+            list(reader.read(fp, header=False))
+        with self.assertRaises(ValueError):
+            list(reader.read(io.StringIO('id,name\n')))
+
+    def test_reader_boolean(self):
+        fields = ({'name': 'b', 'type': 'boolean', 'mapping': {True: 'Y'}},
+                  {'name': 'c', 'type': 'boolean', 'default': False})
+        text = 'Y,True\nFalse,\n'
+        reader = TabularReader(fields, use_numpy=False)
+        batch = next(reader.read(io.StringIO(text), header=False))
+        self.assertEqual([1, 0], list(batch['b']))
+        self.assertEqual([1, 0], list(batch['c']))
+        try:
+            reader = TabularReader(fields, use_numpy=True)
+        except ImportError:
+            self.skipTest('NumPy is not available')
+        batch = next(reader.read(io.StringIO(text), header=False))
+        self.assertEqual([True, False], batch['b'].tolist())
+
+    def test_compile(self):
+        tabular = Tabular((
+            {'name': 'f', 'type': 'float', 'precision': 2},
+            {'name': 'b', 'type': 'boolean', 'mapping': {True: 'Y'}},
+        ))
+        self.assertEqual(['1.23', 'Y'], tabular({'f': 1.2345, 'b': True}))
+        self.assertEqual(['', 'False'], tabular({'f': None, 'b': False}))
+        with self.assertRaises(ValueError):
+            Tabular(({'name': 'x', 'type': 'unknown'}, ))
+
 
 class ConfigLoaderTest(unittest.TestCase):
 
@@ -744,3 +3450,1056 @@ class ConfigLoaderTest(unittest.TestCase):
     def test_invalid_path(self):
         loader = ConfigLoader('notfound')
         self.assertIsNone(loader.load())
+
+
+class MainProcessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.files = []
+        # "f5.csv" duplicates "f0.csv" to be skipped.
+        for i in range(6):
+            path = os.path.join(self.tmpdir.name, 'f{}.csv'.format(i))
+            with open(path, 'w', encoding='utf8') as fp:
+                fp.write('a,b\n' + '1,2\n' * (i % 5))
+            self.files.append(path)
+        path = os.path.join(self.tmpdir.name, 'f6.csv.gz')
+        with gzip.open(path, 'wt', encoding='utf8') as fp:
+            fp.write('a,b\n' + '1,2\n' * 10)
+        self.files.append(path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _run(self, jobs, sqlite=None, hash_jobs=1, chunk_size=0,
+             pipeline=False, gzip_index=False, checkpoint=0, **kwargs):
+        processor = MainProcess(False)
+        processor.initialize(None, os.devnull, 'utf8', sqlite, **kwargs)
+        counter = processor.run(self.files, 'utf8', True, jobs, hash_jobs,
+                                chunk_size, pipeline, gzip_index, checkpoint)
+        cur = processor.localdb.execute(
+            'SELECT path, digest, result FROM _monitor ORDER BY path')
+        rows = cur.fetchall()
+        processor.terminate()
+        return counter, rows
+
+    def test_run_parallel(self):
+        counter, rows = self._run(1)
+        self.assertEqual(Counter(total=7, skip=1, process=6), counter)
+        self.assertEqual((counter, rows), self._run(3))
+
+    def test_run_single_pass(self):
+        expected = self._run(1)
+        self.assertEqual(expected, self._run(1, single_pass=True))
+        self.assertEqual(expected, self._run(3, single_pass=True))
+        # Rerun skips everything by cheap check.
+        sqlite = os.path.join(self.tmpdir.name, 'monitor.sqlite')
+        self._run(1, sqlite, single_pass=True)
+        counter, _ = self._run(1, sqlite, single_pass=True)
+        self.assertEqual(Counter(total=7, skip=7), counter)
+
+    def test_run_unchanged(self):
+        sqlite = os.path.join(self.tmpdir.name, 'monitor.sqlite')
+        self._run(1, sqlite)
+        module = sys.modules[__name__]
+        with mock.patch.object(module, 'filehash', wraps=filehash) as m:
+            counter, _ = self._run(1, sqlite)
+            # Only the duplicated file, which is not recorded, is read.
+            self.assertEqual(1, m.call_count)
+            self.assertEqual(Counter(total=7, skip=7), counter)
+            counter, _ = self._run(1, sqlite, verify_digest=True)
+            self.assertEqual(8, m.call_count)
+            self.assertEqual(Counter(total=7, skip=7), counter)
+
+    def test_run_hash_jobs(self):
+        counter, rows = self._run(1)
+        self.assertEqual((counter, rows), self._run(1, hash_jobs=3))
+        self.assertEqual((counter, rows), self._run(2, hash_jobs=3))
+        counter, rows = self._run(1, algorithm='blake2b')
+        self.assertEqual(Counter(total=7, skip=1, process=6), counter)
+        self.assertEqual(128, len(rows[0][1]))
+        self.assertEqual((counter, rows),
+                         self._run(1, hash_jobs=3, algorithm='blake2b'))
+        self.assertEqual((counter, rows),
+                         self._run(1, single_pass=True, algorithm='blake2b'))
+
+    def test_ingest(self):
+        sqlite = os.path.join(self.tmpdir.name, 'monitor.sqlite')
+        for _ in range(2):
+            counter, _ = self._run(2, sqlite, ingest='t',
+                                   ingest_indexes=['a', 'b, a', 'x'])
+        # Rerun skips everything not to load the rows again.
+        self.assertEqual(Counter(total=7, skip=7), counter)
+        db = sqlite3.connect(sqlite)
+        self.assertEqual([('1', '2', 20)], db.execute(
+            'SELECT a, b, COUNT(*) FROM t GROUP BY a, b').fetchall())
+        self.assertEqual(['t_a', 't_b_a'], [r[0] for r in db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND "
+            "tbl_name = 't' ORDER BY name")])
+        r = db.execute("SELECT result FROM _monitor WHERE path LIKE '%.gz'")
+        self.assertEqual({'lines': 11, 'rows': 10},
+                         json.loads(r.fetchone()[0]))
+        db.close()
+
+    def test_ingest_ragged(self):
+        path = os.path.join(self.tmpdir.name, 'ragged.csv')
+        with open(path, 'w', encoding='utf8') as fp:
+            fp.write('1,"x\ny"\n2\n3,z,extra\n')
+        processor = MainProcess(False)
+        processor.initialize(None, os.devnull, 'utf8', ingest='t')
+        processor.localdb.execute('PRAGMA synchronous = FULL')
+        processor.run([path], 'utf8', False)
+        self.assertEqual({'lines': 4, 'rows': 3}, processor.results())
+        cur = processor.localdb.execute('SELECT * FROM t')
+        self.assertEqual(['c1', 'c2'], [d[0] for d in cur.description])
+        self.assertEqual([('1', 'x\ny'), ('2', None), ('3', 'z')],
+                         cur.fetchall())
+        # PRAGMAs relaxed for the load are restored.
+        self.assertEqual(2, processor.localdb.execute(
+            'PRAGMA synchronous').fetchone()[0])
+        processor.terminate()
+
+    def test_metrics(self):
+        path = os.path.join(self.tmpdir.name, 'metrics.json')
+        counter, _ = self._run(1, metrics=path)
+        with open(path, encoding='utf8') as fp:
+            m = json.load(fp)
+        self.assertEqual({'process': 6, 'skip': 1, 'ignore': 0}, m['files'])
+        self.assertEqual(0, m['files_remaining'])
+        self.assertGreater(m['bytes_read'], 0)
+
+    def test_results(self):
+        # Lines of "f0.csv" to "f4.csv" and "f6.csv.gz" except duplicates.
+        expected = {'lines': 15 + 11}
+        for kwargs in ({'jobs': 1}, {'jobs': 2, 'chunk_size': 5},
+                       {'jobs': 2, 'single_pass': True}):
+            processor = MainProcess(False)
+            processor.initialize(None, os.devnull, 'utf8',
+                                 single_pass=kwargs.pop('single_pass', False))
+            processor.run(self.files, 'utf8', True, **kwargs)
+            self.assertEqual(expected, processor.results())
+            # Skipped files are not aggregated again.
+            processor.run(self.files, 'utf8', True, **kwargs)
+            self.assertEqual(expected, processor.results())
+            processor.terminate()
+
+    def test_results_mixed(self):
+        process = App.process
+
+        def process_with_encoding(app, fp, header):
+            return dict(process(app, fp, header), encoding='utf8')
+        processor = MainProcess(False)
+        processor.initialize(None, os.devnull, 'utf8')
+        with mock.patch.object(App, 'process', process_with_encoding):
+            counter = processor.run(self.files, 'utf8', True)
+        processor.terminate()
+        self.assertEqual(6, counter['process'])
+        self.assertEqual({'lines': 15 + 11, 'encoding': 'utf8'},
+                         processor.results())
+
+    def test_run_chunked(self):
+        expected = self._run(1)
+        self.assertEqual(expected, self._run(2, chunk_size=5))
+        self.assertEqual(expected, self._run(2, chunk_size=5,
+                                             single_pass=True))
+        with mock.patch.object(App, 'needs_text', False):
+            self.assertEqual(expected, self._run(1))
+            self.assertEqual(expected, self._run(1, single_pass=True))
+            self.assertEqual(expected, self._run(2, chunk_size=5,
+                                                 single_pass=True))
+
+    def test_run_gzip_index(self):
+        path = os.path.join(self.tmpdir.name, 'f7.csv.gz')
+        c = zlib.compressobj(wbits=31)
+        with open(path, 'wb') as fp:
+            for i in range(100):
+                fp.write(c.compress(b'%d,%s\n' % (i, b'x' * i)))
+                fp.write(c.flush(zlib.Z_FULL_FLUSH))
+            fp.write(c.flush())
+        self.files.append(path)
+        expected = self._run(1)
+        sqlite = os.path.join(self.tmpdir.name, 'monitor.sqlite')
+        split = GzipIndex.chunks
+        returned = []
+
+        def chunks(points, chunk_size):
+            returned.append(split(points, chunk_size))
+            return returned[-1]
+        module = sys.modules[__name__]
+        # The first run builds the index on processing the file at once,
+        # and the next run of the file fans out by the stored index.
+        for fanout in (False, True):
+            with mock.patch.object(module, 'GZIP_INDEX_SPAN', 100), \
+                    mock.patch.object(GzipIndex, 'build') as build, \
+                    mock.patch.object(GzipIndex, 'chunks',
+                                      side_effect=chunks):
+                self.assertEqual(expected, self._run(2, sqlite,
+                                                     chunk_size=100,
+                                                     gzip_index=True))
+            build.assert_not_called()
+            self.assertEqual(fanout, any(len(r) > 1 for r in returned))
+            db = sqlite3.connect(sqlite)
+            n = db.execute('SELECT COUNT(*) FROM _gzindex').fetchone()[0]
+            self.assertGreater(n, 1)
+            db.execute('DELETE FROM _monitor')
+            db.commit()
+            db.close()
+
+    def test_run_pipeline(self):
+        expected = self._run(1)
+        self.assertEqual(expected, self._run(1, pipeline=True))
+        self.assertEqual(expected, self._run(2, pipeline=True,
+                                             single_pass=True))
+
+    def test_run_output_error(self):
+        sqlite = os.path.join(self.tmpdir.name, 'monitor.sqlite')
+        output = os.path.join(self.tmpdir.name, 'notfound', 'out.csv')
+
+        def process(app, fp, header):
+            app.output.write(fp.read())
+            app.output.flush()
+            # Wait for the thread to fail on opening the partition.
+            for _ in range(100):
+                if app.output.error:
+                    break
+                time.sleep(0.01)
+            return {}
+        processor = MainProcess(False)
+        processor.initialize(None, output, 'utf8', sqlite,
+                             output_partition='input')
+        q = 'SELECT COUNT(*) FROM _monitor WHERE finish_at IS NOT NULL'
+        with mock.patch.object(App, 'process', process):
+            self.assertRaises(OSError, processor.run, self.files, 'utf8',
+                              True)
+        # No input is recorded as processed, nor committed on terminating.
+        self.assertEqual(0, processor.localdb.execute(q).fetchone()[0])
+        self.assertRaises(OSError, processor.terminate)
+        processor.localdb.close()
+        db = sqlite3.connect(sqlite)
+        self.assertEqual(0, db.execute(q).fetchone()[0])
+        db.close()
+
+    @unittest.skipUnless(os.path.exists('/dev/full'), 'requires /dev/full')
+    def test_run_output_full(self):
+        sqlite = os.path.join(self.tmpdir.name, 'monitor.sqlite')
+
+        def process(app, fp, header):
+            # Buffered, and fails only on writing to the file.
+            app.output.write(fp.read())
+            return {'lines': 1}
+        processor = MainProcess(False)
+        # Group commit on every file.
+        processor.initialize(None, '/dev/full', 'utf8', sqlite,
+                             commit_every=1)
+        with mock.patch.object(App, 'process', process):
+            self.assertRaises(OSError, processor.run, self.files, 'utf8',
+                              True)
+        self.assertRaises(OSError, processor.terminate)
+        processor.localdb.close()
+        db = sqlite3.connect(sqlite)
+        n = db.execute('SELECT COUNT(*) FROM _monitor '
+                       'WHERE finish_at IS NOT NULL').fetchone()[0]
+        db.close()
+        self.assertEqual(0, n)
+
+    def test_run_stats(self):
+        sqlite = os.path.join(self.tmpdir.name, 'monitor.sqlite')
+        for kwargs in ({}, {'single_pass': True},
+                       {'jobs': 2, 'chunk_size': 5}):
+            processor = MainProcess(False)
+            processor.initialize(None, os.devnull, 'utf8', sqlite,
+                                 single_pass=kwargs.get('single_pass', False))
+            processor.run(self.files, 'utf8', True, kwargs.get('jobs', 1),
+                          chunk_size=kwargs.get('chunk_size', 0))
+            rows = processor.localdb.execute(
+                'SELECT path, size, hash_time, open_time, process_time, '
+                'bytes_read, throughput FROM _monitor ORDER BY seq').fetchall()
+            processor.terminate()
+            os.remove(sqlite)
+            self.assertEqual(6, len(rows))
+            for r in rows:
+                self.assertTrue(all(v is not None for v in r), (kwargs, r))
+                if r[0].endswith('.gz'):
+                    self.assertEqual(len('a,b\n' + '1,2\n' * 10), r[5])
+                else:
+                    self.assertEqual(r[1], r[5])
+
+    def test_run_checkpoint(self):
+        data = b''.join(b'%d,%d\n' % (i, i) for i in range(400000))
+        sqlite = os.path.join(self.tmpdir.name, 'monitor.sqlite')
+        path = os.path.join(self.tmpdir.name, 'big.csv')
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        with gzip.open(path + '.gz', 'wb') as fp:
+            fp.write(data)
+        rest = data[SCAN_BLOCK_SIZE:].count(b'\n')
+        for f, pipeline, index in ((path, False, False),
+                                   (path + '.gz', False, False),
+                                   (path + '.gz', True, False),
+                                   (path + '.gz', False, True)):
+            # Crashed after the first checkpoint of 7 lines.
+            db = sqlite3.connect(sqlite)
+            monitor = ProgressMonitor(db)
+            monitor.start(f)
+            monitor.checkpoint(SCAN_BLOCK_SIZE, 7, {'lines': 7})
+            if index:
+                GzipIndex(db).save(monitor.current, GzipIndex.build(f))
+                db.commit()
+            db.close()
+            self.files = [f]
+            # Only `App.scan()` saves checkpoints.
+            with mock.patch.object(App, 'needs_text', False):
+                counter, rows = self._run(1, sqlite, pipeline=pipeline,
+                                          gzip_index=index, checkpoint=1)
+            self.assertEqual(Counter(total=1, process=1), counter)
+            self.assertEqual({'lines': 7 + rest}, json.loads(rows[0][2]))
+            db = sqlite3.connect(sqlite)
+            r = db.execute('SELECT checkpoint_offset FROM _monitor').fetchone()
+            db.close()
+            self.assertEqual(len(data), r[0])
+            os.remove(sqlite)
+
+    def test_run_checkpoint_ignored(self):
+        expected = self._run(1)
+        # `App.process()` on text cannot save the progress.
+        with self.assertLogs(APPNAME + '.main', 'WARNING') as cm:
+            self.assertEqual(expected, self._run(1, checkpoint=1))
+        self.assertIn('App.process()', cm.output[0])
+        with mock.patch.object(App, 'needs_text', False), \
+                self.assertLogs(APPNAME + '.main', 'WARNING') as cm:
+            self.assertEqual(expected, self._run(2, checkpoint=1))
+        self.assertIn('serial run', cm.output[0])
+
+    def test_watch(self):
+        expected = self._run(1)
+        processor = MainProcess(False)
+        processor.initialize(None, os.devnull, 'utf8')
+        watcher = DirectoryWatcher([self.tmpdir.name], settle=0)
+        poll = watcher.poll
+
+        def stop():
+            # Stop after the second poll, which finds nothing.
+            processor.stopped.set()
+            return poll()
+        with mock.patch.object(watcher, 'poll',
+                               side_effect=lambda: calls.pop(0)()) as m:
+            calls = [poll, stop]
+            processor.watch(watcher, 0, 'utf8', True)
+            self.assertEqual(2, m.call_count)
+        cur = processor.localdb.execute(
+            'SELECT path, digest, result FROM _monitor ORDER BY path')
+        self.assertEqual(expected[1], cur.fetchall())
+        processor.terminate()
+
+    def test_shard(self):
+        # Duplicated files in the tree, "sub/f0.csv" and "f5.csv".
+        os.mkdir(os.path.join(self.tmpdir.name, 'sub'))
+        shutil.copy(self.files[0], os.path.join(self.tmpdir.name, 'sub'))
+        files = collect_files([self.tmpdir.name], recursive=True)
+        # Merged in the order of the inputs, not in the lexical order.
+        for self.files in (files, files[::-1]):
+            self._merge_shards()
+
+    def _merge_shards(self):
+        q = 'SELECT seq, path, size, digest, result FROM _monitor'
+        processor = MainProcess(False)
+        processor.initialize(None, os.devnull, 'utf8')
+        expected = processor.run(self.files, 'utf8', True)
+        results = processor.results()
+        rows = processor.localdb.execute(q).fetchall()
+        processor.terminate()
+        for n in (2, 3, 5):
+            paths = []
+            for i in range(n):
+                paths.append(os.path.join(self.tmpdir.name,
+                                          'shard{}.sqlite'.format(i)))
+                self._run(1, paths[-1], shard=(i, n))
+            processor = MainProcess(False)
+            processor.initialize(None, os.devnull, 'utf8')
+            self.assertEqual(expected, processor.merge(paths))
+            self.assertEqual(rows, processor.localdb.execute(q).fetchall())
+            self.assertEqual(results, processor.results())
+            processor.terminate()
+            for path in paths:
+                os.remove(path)
+
+    def test_in_shard(self):
+        paths = ['in/f{}.csv'.format(i) for i in range(100)]
+        for n in (2, 4, 8, 16):
+            counts = [sum(1 for p in paths if in_shard(p, (i, n)))
+                      for i in range(n)]
+            self.assertEqual(len(paths), sum(counts))
+            # Similar paths are spread over the shards.
+            for c in counts:
+                self.assertTrue(0 < c < len(paths) / n * 2, (n, counts))
+        self.assertEqual(in_shard('in/f0.csv', (1, 2)),
+                         in_shard('in\\f0.csv', (1, 2)))
+
+    def test_shard_type(self):
+        self.assertEqual((0, 2), shard_type('0/2'))
+        for value in ('2/2', '-1/2', '1', 'a/b'):
+            self.assertRaises(argparse.ArgumentTypeError, shard_type, value)
+        self.assertLess(walk_key('a/z.csv'), walk_key('a/b/c.csv'))
+        self.assertLess(walk_key('a/b/c.csv'), walk_key('a/c/b.csv'))
+
+    def test_run_stream(self):
+        expected = self._run(1)
+        self.files = iter_files([self.tmpdir.name], recursive=True)
+        self.assertEqual(expected, self._run(1))
+        self.files = iter_files([self.tmpdir.name], recursive=True)
+        self.assertEqual(expected, self._run(2, hash_jobs=2))
+
+
+class ProgressMonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.sqlite = os.path.join(self.tmpdir.name, 'monitor.sqlite')
+        self.files = []
+        for i in range(5):
+            path = os.path.join(self.tmpdir.name, 'f{}.csv'.format(i))
+            with open(path, 'w', encoding='utf8') as fp:
+                fp.write('a,b\n' * (i + 1))
+            self.files.append(path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _count(self):
+        # Count records visible from another connection.
+        db = sqlite3.connect(self.sqlite)
+        r = db.execute('SELECT COUNT(*) FROM _monitor '
+                       'WHERE finish_at IS NOT NULL').fetchone()
+        db.close()
+        return r[0]
+
+    def test_group_commit(self):
+        db = sqlite3.connect(self.sqlite)
+        monitor = ProgressMonitor(db, commit_every=2, commit_interval=0)
+        journal_mode = db.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual('wal', journal_mode)
+        for i, path in enumerate(self.files):
+            monitor.start(path)
+            monitor.finish({'lines': i + 1})
+            self.assertEqual((i + 1) // 2 * 2, self._count())
+        monitor.commit()
+        self.assertEqual(5, self._count())
+        db.close()
+
+    def _dump(self, monitor, fields, since=None):
+        monitor.dump = os.path.join(self.tmpdir.name, 'dump.tsv.gz')
+        n = monitor.terminate(fields, since)
+        with gzip.open(monitor.dump, 'rt', encoding='utf8') as fp:
+            rows = [line.rstrip('\n').split('\t') for line in fp]
+        self.assertEqual(n, len(rows) - 1)
+        return rows
+
+    def test_terminate(self):
+        monitor = ProgressMonitor(sqlite3.connect(':memory:'))
+        for i, path in enumerate(self.files):
+            monitor.start(path)
+            monitor.finish({'lines': i + 1})
+        rows = self._dump(monitor, MONITOR_DUMP_FIELDS)
+        self.assertEqual(6, len(rows))
+        self.assertEqual(['1', self.files[0].replace('\\', '/'), 'f0.csv',
+                          '.csv', '4', '', '1'], rows[1][:7])
+        fields = (
+            {'name': 'seq', 'type': 'integer'},
+            {'name': 'basename', 'type': 'string'},
+        )
+        # Results are not decoded for the fields above.
+        with mock.patch.object(json, 'loads') as m:
+            rows = self._dump(monitor, fields, since=3)
+            self.assertFalse(m.called)
+        self.assertEqual([['seq', 'basename'], ['4', 'f3.csv'],
+                          ['5', 'f4.csv']], rows)
+
+    def test_fingerprint(self):
+        # "b" is a copy of "a", and "c" differs from "a" out of the samples.
+        data = bytearray(os.urandom(4 * FINGERPRINT_SAMPLE_SIZE))
+        paths = [os.path.join(self.tmpdir.name, n) for n in 'abc']
+        for i, path in enumerate(paths):
+            if i == 2:
+                data[FINGERPRINT_SAMPLE_SIZE + 10] ^= 0xff
+            with open(path, 'wb') as fp:
+                fp.write(data)
+        full = [filehash(p) for p in paths]
+        sample = [fingerprint(p) for p in paths]
+        self.assertEqual(1, len(set(sample)))
+        self.assertEqual(2, len(set(full)))
+        monitor = ProgressMonitor(sqlite3.connect(':memory:'),
+                                  fingerprint_size=1)
+        self.assertIsNone(monitor.start(paths[0]))
+        monitor.finish()
+        # The same samples are compared by the full digests.
+        self.assertIsNotNone(monitor.start(paths[1]))
+        self.assertIsNone(monitor.start(paths[2]))
+        monitor.finish()
+        rows = monitor.db.execute('SELECT path, digest, digest_type '
+                                  'FROM _monitor ORDER BY seq').fetchall()
+        self.assertEqual([(paths[0], full[0], 'full'),
+                          (paths[2], sample[2], 'sample')], rows)
+        # Upgrade in the background.
+        monitor = ProgressMonitor(sqlite3.connect(':memory:'),
+                                  fingerprint_size=1, upgrade_digest=True)
+        monitor.start(paths[0])
+        monitor.finish()
+        monitor.upgrade(wait=True)
+        rows = monitor.db.execute('SELECT path, digest, digest_type '
+                                  'FROM _monitor ORDER BY seq').fetchall()
+        self.assertEqual([(paths[0], full[0], 'full')], rows)
+
+
+class IterFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        for d in ('a', 'a/b', 'a/.hidden', 'c', 'a/b/d'):
+            os.mkdir(os.path.join(self.tmpdir.name, d))
+        for f in ('z.txt', 'a/y.txt', 'a/y.txt~', 'a/b/x.txt', 'a/.hidden/w',
+                  'a/b/d/v.txt', 'c/u.txt', 'a/.t.txt'):
+            with open(os.path.join(self.tmpdir.name, f), 'w') as fp:
+                fp.write(f)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_iter_files(self):
+        inputs = [self.tmpdir.name, os.path.join(self.tmpdir.name, 'z.txt')]
+        expected = collect_files(inputs, recursive=True)
+        self.assertEqual(7, len(expected))
+        actual = [file_stat(f)[0] for f in iter_files(inputs, recursive=True)]
+        self.assertEqual(expected, actual)
+
+    def test_iter_files_empty(self):
+        self.assertEqual([], iter_files(None))
+        self.assertEqual([], iter_files([]))
+
+
+class DirectoryWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        for d in ('a', 'a/b', '.hidden'):
+            os.mkdir(os.path.join(self.root, d))
+        for f in ('z.txt', 'a/y.txt', 'a/b/x.txt', 'a/y.txt~', '.hidden/w'):
+            self._write(f, old=True)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _write(self, name, data='1\n', old=False):
+        path = os.path.join(self.root, name)
+        with open(path, 'a') as fp:
+            fp.write(data)
+        if old:
+            os.utime(path, (time.time() - 3600, ) * 2)
+        return path
+
+    def test_poll(self):
+        watcher = DirectoryWatcher([self.root], recursive=True, settle=60)
+        self.assertEqual(collect_files([self.root], True), watcher.poll())
+        # Unchanged tree is not listed again.
+        with mock.patch.object(os, 'scandir', wraps=os.scandir) as m:
+            self.assertEqual([], watcher.poll())
+            self.assertFalse(m.called)
+        # New file is reported after its stat is settled.
+        path = self._write('a/b/v.txt')
+        self.assertEqual([], watcher.poll())
+        self._write('a/b/v.txt')
+        self.assertEqual([], watcher.poll())
+        self.assertEqual([path], watcher.poll())
+        self.assertEqual([], watcher.poll())
+        # So is new directory, and file copied into is reported at once.
+        os.mkdir(os.path.join(self.root, 'c'))
+        path = self._write('c/u.txt', old=True)
+        self.assertEqual([path], watcher.poll())
+        shutil.rmtree(os.path.join(self.root, 'a'))
+        self.assertEqual([], watcher.poll())
+        self.assertNotIn(os.path.join(self.root, 'a', 'b'), watcher.dirs)
+
+    def test_poll_file(self):
+        path = self._write('t.txt')
+        watcher = DirectoryWatcher([path], settle=60)
+        self.assertEqual([], watcher.poll())
+        self.assertEqual([path], watcher.poll())
+        self.assertEqual([], watcher.poll())
+        self._write('t.txt', old=True)
+        self.assertEqual([path], watcher.poll())
+
+
+class AppTest(unittest.TestCase):
+
+    def test_scan(self):
+        app = App(None)
+        data = ('', 'a,b', 'a,b\n', 'a,b\n1,2', 'a,b\n1,2\n\n', '\u3042\n' * 9,
+                'a,b\r1,2\r', 'a\r\nb\r\n\r\r\n', 'a\rb\n\nc\r')
+        module = sys.modules[__name__]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'input.csv')
+            for text in data:
+                with open(path, 'w', encoding='utf8', newline='') as fp:
+                    fp.write(text)
+                for header in (True, False):
+                    if header and not text:
+                        continue
+                    # Universal newlines of text mode.
+                    with open_input(path, 'utf8') as fp:
+                        expected = app.process(fp, header)
+                    raw = io.BytesIO(text.encode('utf8'))
+                    self.assertEqual(expected, app.scan(raw, header))
+                    # Separators split by small blocks.
+                    for size in (1, 2, 3):
+                        with mock.patch.object(module, 'SCAN_BLOCK_SIZE',
+                                               size), \
+                                open_binary(path) as fp:
+                            self.assertEqual(expected, app.scan(fp, header))
+        # Opt-in not to bypass `process()`.
+        self.assertTrue(App.needs_text)
+
+    def test_scan_resume(self):
+        app = App(None)
+        data = b'a,b\n1,2\r\n3,4\r5,6'
+        expected = app.scan(io.BytesIO(data), True)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'input.csv')
+            with open(path, 'wb') as fp:
+                fp.write(data)
+            with gzip.open(path + '.gz', 'wb') as fp:
+                fp.write(data)
+            # Checkpoints in the middle of lines, of "\r\n" and at EOF.
+            for offset in range(1, len(data) + 1):
+                head = data[:offset]
+                lines = (head.count(b'\n') + head.count(b'\r') -
+                         head.count(b'\r\n'))
+                resume = (offset, lines, None)
+                for f, pipeline in ((path, False), (path + '.gz', False),
+                                    (path + '.gz', True)):
+                    with open_binary(f, pipeline=pipeline) as fp:
+                        self.assertEqual(expected, app.scan(fp, True, resume),
+                                         (f, offset))
+
+    def test_split_chunks(self):
+        app = App(None)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'input.csv')
+            with open(path, 'w', encoding='utf8') as fp:
+                fp.write('id,name\n' + ''.join(
+                    '{},{}\n'.format(i, 'x' * (i % 7)) for i in range(100)))
+                fp.write('last')
+            with open(path, encoding='utf8') as fp:
+                expected = app.process(fp, True)
+            size = os.path.getsize(path)
+            for chunk_size in (1, 10, 100, size - 1, size, size + 1):
+                chunks = split_chunks(path, chunk_size)
+                self.assertEqual(0, chunks[0][0])
+                self.assertEqual(size, chunks[-1][1])
+                with open(path, 'rb') as fp:
+                    data = fp.read()
+                for start, end in chunks[1:]:
+                    self.assertEqual(b'\n', data[start - 1:start])
+                for needs_text in (False, True):
+                    app.needs_text = needs_text
+                    r = app.merge(process_range(app, path, 'utf8', True,
+                                                start, end)[0]
+                                  for start, end in chunks)
+                    self.assertEqual(expected, r)
+
+    def test_reducer(self):
+        reducer = Reducer()
+        results = [{'lines': 1}, None, {'lines': 2, 'x': 1}, {'lines': 3}]
+        expected = {'lines': 6, 'x': 1}
+        self.assertEqual(expected, reducer.reduce(results))
+        # Any grouping gives the same aggregate.
+        self.assertEqual(expected, reducer.reduce(
+            [reducer.reduce(results[:2]), reducer.reduce(results[2:])]))
+        self.assertIsNone(reducer.reduce([None]))
+        self.assertEqual(expected, App(None).merge(results))
+        # Values other than numbers are not summed up.
+        results = [{'lines': 1, 'encoding': 'utf8', 'header': True},
+                   {'lines': 2, 'encoding': 'cp932', 'header': True}]
+        self.assertEqual({'lines': 3, 'encoding': 'utf8', 'header': True},
+                         reducer.reduce(results))
+
+    def test_ascii_compatible(self):
+        self.assertTrue(ascii_compatible('utf8'))
+        self.assertTrue(ascii_compatible('cp932'))
+        self.assertFalse(ascii_compatible('utf-16'))
+        self.assertFalse(ascii_compatible('utf-32-le'))
+
+
+class GzipPipeReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp('.gz')
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def _read(self, **kwargs):
+        with GzipPipeReader(self.path, **kwargs) as raw:
+            return io.BufferedReader(raw).read()
+
+    def test_read(self):
+        data = b''.join(b'%d,%d\n' % (i, i * i) for i in range(100000))
+        # Multiple members with zero padding as `gzip` accepts.
+        with open(self.path, 'wb') as fp:
+            fp.write(gzip.compress(data) + gzip.compress(data[:10]))
+            fp.write(gzip.compress(b'') + b'\0' * 10)
+        self.assertEqual(data + data[:10], self._read())
+        self.assertEqual(data + data[:10],
+                         self._read(block_size=100, depth=1))
+
+    def test_close(self):
+        data = os.urandom(1024 * 1024)
+        with open(self.path, 'wb') as fp:
+            fp.write(gzip.compress(data, compresslevel=1))
+        # Stop the thread blocked by the full queue.
+        with GzipPipeReader(self.path, block_size=1024, depth=1) as raw:
+            self.assertEqual(data[:10], raw.read(10))
+        self.assertFalse(raw.thread.is_alive())
+
+    def test_truncated(self):
+        with open(self.path, 'wb') as fp:
+            fp.write(gzip.compress(b'a,b\n' * 1000)[:-10])
+        with self.assertRaises(EOFError):
+            self._read()
+
+
+class OutputWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _read(self, path):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf8') as fp:
+            return fp.read()
+
+    def test_write(self):
+        lines = ['{},\u3042\n'.format(i) for i in range(1000)]
+        for name in ('out.csv', 'out.csv.gz'):
+            path = os.path.join(self.tmpdir.name, name)
+            # Small buffer and queue to block on the writer thread.
+            with OutputWriter(path, 'utf8', 100, 1) as writer:
+                for line in lines:
+                    writer.write(line)
+            self.assertEqual(''.join(lines), self._read(path))
+
+    def test_partition(self):
+        path = os.path.join(self.tmpdir.name, 'out.csv.gz')
+        with OutputWriter(path, 'utf8', partition=3) as writer:
+            for i in range(7):
+                writer.write('{}\n'.format(i))
+            # Lines written at once are not split.
+            writer.write('7\n8\n9\n10\n')
+        self.assertEqual(['out-00001.csv.gz', 'out-00002.csv.gz',
+                          'out-00003.csv.gz'],
+                         sorted(os.listdir(self.tmpdir.name)))
+        self.assertEqual('3\n4\n5\n', self._read(writer.partition_path(2)))
+        self.assertEqual('6\n7\n8\n9\n10\n',
+                         self._read(writer.partition_path(3)))
+        path = os.path.join(self.tmpdir.name, 'in.tsv')
+        with OutputWriter(path, 'utf8', partition='input') as writer:
+            for i in range(3):
+                writer.next_input()
+                if i != 1:
+                    writer.write('{}\n'.format(i))
+        # No file for the input without output.
+        self.assertEqual('2\n', self._read(writer.partition_path(2)))
+        self.assertFalse(os.path.exists(writer.partition_path(3)))
+        self.assertEqual('input', partition_type('input'))
+        self.assertEqual(10, partition_type('10'))
+        for value in ('0', 'x'):
+            self.assertRaises(argparse.ArgumentTypeError, partition_type,
+                              value)
+
+    def test_error(self):
+        path = os.path.join(self.tmpdir.name, 'notfound', 'out.csv')
+        # Raised on opening the output file.
+        self.assertRaises(OSError, OutputWriter, path, 'utf8')
+        writer = OutputWriter(path, 'utf8', 10, 1, partition=2)
+        # Raised by either `write()` or `close()` in the main thread.
+        with self.assertRaises(OSError):
+            with writer:
+                for _ in range(100):
+                    writer.write('x' * 10)
+        self.assertTrue(writer.closed)
+        self.assertRaises(OSError, writer.check)
+        if os.path.exists('/dev/full'):
+            # Written only on closing the file, which fails by ENOSPC.
+            writer = OutputWriter('/dev/full', 'utf8')
+            writer.write('x\n')
+            self.assertRaises(OSError, writer.close)
+            self.assertFalse(writer.thread.is_alive())
+
+
+class GzipIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp('.gz')
+        os.close(fd)
+        self.data = b''.join(b'%d,%d\n' % (i, i * i) for i in range(20000))
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def _read(self, point):
+        compressed, uncompressed, kind, window = point
+        self.assertEqual(self.data[max(uncompressed - len(window), 0):
+                                   uncompressed], window)
+        with GzipPipeReader(self.path, start=compressed,
+                            window=window if kind == 'flush' else None) as r:
+            return io.BufferedReader(r).read()
+
+    def _read_by(self, builder, block_size=GZIP_BLOCK_SIZE):
+        with GzipPipeReader(self.path, block_size=block_size,
+                            builder=builder) as r:
+            return io.BufferedReader(r).read()
+
+    def test_build(self):
+        # Sync flush every 1000 bytes, and two members.
+        c = zlib.compressobj(wbits=31)
+        with open(self.path, 'wb') as fp:
+            for i in range(0, 50000, 1000):
+                fp.write(c.compress(self.data[i:i + 1000]))
+                fp.write(c.flush(zlib.Z_SYNC_FLUSH))
+            fp.write(c.flush())
+            fp.write(gzip.compress(self.data[50000:]))
+        points = GzipIndex.build(self.path, span=5000)
+        self.assertEqual([0, 5000, 10000], [p[1] for p in points[:3]])
+        self.assertIn((50000, 'member'), [(p[1], p[2]) for p in points])
+        for point in points:
+            self.assertEqual(self.data[point[1]:], self._read(point))
+        # Same points found on decompressing to process, and valid ones
+        # by smaller blocks, which split some of the flush markers.
+        builder = GzipIndexBuilder(span=5000)
+        self.assertEqual(self.data, self._read_by(builder))
+        self.assertEqual(points, builder.points)
+        builder = GzipIndexBuilder(span=5000)
+        self.assertEqual(self.data, self._read_by(builder, 100))
+        for point in builder.points:
+            self.assertEqual(self.data[point[1]:], self._read(point))
+        db = sqlite3.connect(':memory:')
+        GzipIndex(db).save('x', points)
+        self.assertEqual(points, GzipIndex(db).load('x'))
+        self.assertIsNone(GzipIndex(db).load('y'))
+
+    def test_build_single_stream(self):
+        with open(self.path, 'wb') as fp:
+            fp.write(gzip.compress(self.data))
+        points = GzipIndex.build(self.path, span=5000)
+        self.assertEqual([(0, 0)], [p[:2] for p in points])
+
+    def test_process_gzip_range(self):
+        app = App(None)
+        c = zlib.compressobj(wbits=31)
+        with open(self.path, 'wb') as fp:
+            # Flush in the middle of lines.
+            for i in range(0, len(self.data), 777):
+                fp.write(c.compress(self.data[i:i + 777]))
+                fp.write(c.flush(zlib.Z_FULL_FLUSH))
+            fp.write(c.flush())
+        points = GzipIndex.build(self.path, span=1)
+        expected = app.process(io.StringIO(self.data.decode()), True)
+        for chunk_size in (1000, 5000, 10 ** 9):
+            chunks = GzipIndex.chunks(points, chunk_size)
+            for needs_text in (False, True):
+                app.needs_text = needs_text
+                r = app.merge(process_gzip_range(app, self.path, 'utf8', True,
+                                                 point, limit)[0]
+                              for point, limit in chunks)
+                self.assertEqual(expected, r)
+
+    def test_resume(self):
+        app = App(None)
+        app.needs_text = False
+        c = zlib.compressobj(wbits=31)
+        with open(self.path, 'wb') as fp:
+            for i in range(0, len(self.data), 1000):
+                fp.write(c.compress(self.data[i:i + 1000]))
+                fp.write(c.flush(zlib.Z_SYNC_FLUSH))
+            fp.write(c.flush())
+        builder = GzipIndexBuilder(span=5000)
+        expected = process_path(app, self.path, 'utf8', True,
+                                builder=builder)[0]
+        points = builder.points
+        self.assertEqual(points, GzipIndex.build(self.path, span=5000))
+        self.assertGreater(len(points), 10)
+        original = skip_bytes
+
+        def skip(fp, n):
+            # Decompressed from the point before the checkpoint.
+            self.assertLess(n - fp.tell(), 5000 + 1000)
+            original(fp, n)
+        module = sys.modules[__name__]
+        for offset in (12, 20000, 50000, len(self.data)):
+            if offset < len(self.data):
+                offset = self.data.index(b'\n', offset) + 1
+            resume = (offset, self.data.count(b'\n', 0, offset), None)
+            with mock.patch.object(module, 'skip_bytes',
+                                   side_effect=skip) as m:
+                r = process_path(app, self.path, 'utf8', True, resume=resume,
+                                 points=points)[0]
+            self.assertEqual(expected, r)
+            self.assertEqual(1, m.call_count)
+
+
+class MetricsReporterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_metrics(self):
+        path = os.path.join(self.tmpdir.name, 'metrics.json')
+        reporter = MetricsReporter(path, 3600)
+        counter = Counter(total=3, process=2, skip=1)
+        reporter.begin(counter, 10)
+        reporter.finish({'bytes_read': 100})
+        reporter.finish({'bytes_read': 50})
+        m = reporter.metrics()
+        self.assertEqual({'process': 2, 'skip': 1, 'ignore': 0}, m['files'])
+        self.assertEqual(7, m['files_remaining'])
+        self.assertGreater(m['eta_seconds'], 0)
+        self.assertGreater(m['bytes_per_second'], 0)
+        # Next run of unknown files adds up the previous one.
+        reporter.begin(Counter(total=1, ignore=1))
+        reporter.close()
+        self.assertEqual(['metrics.json'], os.listdir(self.tmpdir.name))
+        with open(path, encoding='utf8') as fp:
+            m = json.load(fp)
+        self.assertEqual({'process': 2, 'skip': 1, 'ignore': 1}, m['files'])
+        self.assertEqual(150, m['bytes_read'])
+        self.assertIsNone(m['files_remaining'])
+        self.assertIsNone(m['eta_seconds'])
+
+    def test_prometheus(self):
+        path = os.path.join(self.tmpdir.name, 'metrics.prom')
+        # Written periodically by the thread.
+        reporter = MetricsReporter(path, 0.01)
+        reporter.begin(Counter(total=2, process=2), 2)
+        for _ in range(100):
+            if os.path.exists(path):
+                break
+            time.sleep(0.01)
+        reporter.close()
+        with open(path, encoding='utf8') as fp:
+            lines = fp.read().splitlines()
+        self.assertIn(APPNAME + '_files_total{category="process"} 2', lines)
+        self.assertIn(APPNAME + '_files_remaining 0', lines)
+        self.assertIn('# TYPE {}_eta_seconds gauge'.format(APPNAME), lines)
+        # Samples are "name value", or "name{labels} value".
+        for line in lines:
+            if not line.startswith('#'):
+                float(line.split(' ')[-1])
+
+
+class LoggingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.loggers = [logging.getLogger(name) for name in ('', APPNAME)]
+        self.saved = [(lg, list(lg.handlers), lg.level, lg.propagate)
+                      for lg in self.loggers]
+
+    def tearDown(self):
+        stop_logging()
+        for lg, handlers, level, propagate in self.saved:
+            for h in lg.handlers:
+                h.close()
+            lg.handlers, lg.level, lg.propagate = handlers, level, propagate
+        self.tmpdir.cleanup()
+
+    def test_setup_logging(self):
+        module = sys.modules[__name__]
+        with mock.patch.object(module, 'DEFAULT_LOG_DIRECTORY',
+                               self.tmpdir.name), \
+                mock.patch('sys.stderr', io.StringIO()) as stderr:
+            setup_logging()
+            for lg in self.loggers:
+                self.assertEqual([_LocalQueueHandler],
+                                 [type(h) for h in lg.handlers])
+            logger = logging.getLogger(APPNAME + '.test')
+            logger.setLevel(logging.DEBUG)
+            args = ['a']
+            logger.debug('Args: %s', args)
+            # Logged as the arguments were on the call.
+            args.append('b')
+            # Handled on the listener thread, but in order.
+            logger.warning('Done: %d', 1)
+            stop_logging()
+            self.assertIn('Done: 1', stderr.getvalue())
+            self.assertNotIn('Args', stderr.getvalue())
+        with open(os.path.join(self.tmpdir.name, APPNAME + '.log'),
+                  encoding='utf8') as fp:
+            lines = fp.read().splitlines()
+        self.assertIn("Args: ['a']", lines[0])
+        self.assertIn('Done: 1', lines[1])
+        self.assertNotIn(_LocalQueueHandler,
+                         [type(h) for h in self.loggers[1].handlers])
+
+
+class ImportTimeTest(unittest.TestCase):
+
+    # Modules imported by the code paths using them, not on start up.
+    LAZY_MODULES = ('concurrent.futures', 'configparser', 'csv', 'gzip',
+                    'hashlib', 'json', 'logging.config', 'sqlite3',
+                    'tempfile', 'unittest')
+    # Sum of "python -X importtime" of `--version`, measured about 45 msec
+    # with Python 3.11 on Linux, including the interpreter itself.
+    BUDGET = 0.1
+
+    def _importtime(self):
+        # Imported modules and the sum of their self time in seconds.
+        p = subprocess.run([sys.executable, '-X', 'importtime', '-m', APPNAME,
+                            '--version'], cwd=BASEDIR, stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE, universal_newlines=True,
+                           check=True)
+        modules, total = set(), 0
+        for line in p.stderr.splitlines():
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+            t, _, name = line[len('import time:'):].split('|')
+            modules.add(name.strip())
+            total += int(t)
+        return modules, total / 1000000
+
+    def test_importtime(self):
+        modules, total = self._importtime()
+        for name in ImportTimeTest.LAZY_MODULES:
+            self.assertNotIn(name, modules)
+        # The best of a few runs not to fail on a noisy machine.
+        for _ in range(2):
+            if total <= ImportTimeTest.BUDGET:
+                break
+            total = min(total, self._importtime()[1])
+        self.assertLessEqual(total, ImportTimeTest.BUDGET)
+
+
+class FileHashTest(unittest.TestCase):
+
+    def test_algorithms(self):
+        self.assertEqual(sorted(a for a in hashlib.algorithms_guaranteed
+                                if not a.startswith('shake_')),
+                         list(HASH_ALGORITHMS))
+
+    def test_filehash(self):
+        data = b'a,b\n1,2\n' * 1000
+        with tempfile.NamedTemporaryFile() as fp:
+            fp.write(data)
+            fp.flush()
+            for algorithm in ('md5', 'sha256', 'blake2b'):
+                expected = hashlib.new(algorithm, data).hexdigest()
+                self.assertEqual(expected, filehash(fp.name, algorithm))
+                self.assertEqual(expected,
+                                 filehash(fp.name, algorithm, buffer_size=7))
+        with tempfile.NamedTemporaryFile() as fp:
+            self.assertEqual(hashlib.md5().hexdigest(), md5sum(fp.name))